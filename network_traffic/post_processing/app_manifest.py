@@ -0,0 +1,162 @@
+"""
+Manifests of the per-app results of the pipeline, so that apps whose inputs did not change are not processed again.
+The manifest of an app records the hashes of everything its CSV rows depend on:
+- its COMPLETED*.pcapng files,
+- the rules of the filter lists,
+- the code of the modules that produce the rows, which include the PII configuration (json_keys.py),
+- the options of the pipeline that change the rows.
+The rows are kept in a rows file next to the manifest, in JSON so that their values are read back unchanged.
+"""
+
+import hashlib
+import json
+import os
+
+import block_decision_store
+
+MANIFEST_FILE_SUFFIX = "-manifest.json"
+ROWS_FILE_SUFFIX = "-rows.json"
+
+# Prefix of the PCAP files of an app, as merged by merge_cap.py
+PCAP_FILE_PREFIX = "COMPLETED"
+PCAP_FILE_EXTENSION = ".pcapng"
+
+POST_PROCESSING_DIR = os.path.dirname(os.path.abspath(__file__))
+# Code of the modules that produce the CSV rows of an app, and the PII configuration (json_keys.py)
+STAGE_FILES = [os.path.join(POST_PROCESSING_DIR, name) for name in ["process_pcaps.py",
+                                                                     "merge_cap.py",
+                                                                     "extract_from_tshark.py",
+                                                                     "json_keys.py",
+                                                                     "pii_helper.py",
+                                                                     "packet_record.py",
+                                                                     "nomoads_format.py",
+                                                                     "filter_list_checker_mult_dirs.py",
+                                                                     "block_decision_cache.py",
+                                                                     "block_decision_store.py",
+                                                                     "esld_resolver.py",
+                                                                     "compare_results.py",
+                                                                     os.path.join("utils", "utils.py")]]
+
+json_key_inputs = "inputs"
+json_key_size = "size"
+json_key_mtime = "mtime_ns"
+json_key_hash = "sha256"
+json_key_filter_lists = "filter_lists"
+json_key_code = "code"
+json_key_options = "options"
+
+
+def get_manifest_file(result_dir, apk_dir):
+    """
+    :param result_dir: The directory of the results of the app.
+    :param apk_dir: The name of the app subdirectory.
+    :return: The path to the manifest of the app.
+    """
+    return os.path.join(result_dir, apk_dir + MANIFEST_FILE_SUFFIX)
+
+
+def get_rows_file(result_dir, apk_dir):
+    """
+    :return: The path to the rows file of the app.
+    """
+    return os.path.join(result_dir, apk_dir + ROWS_FILE_SUFFIX)
+
+
+def _get_code_hash():
+    code_hash = hashlib.sha256()
+    for path in STAGE_FILES:
+        code_hash.update(block_decision_store.get_file_hash(path).encode("utf-8"))
+    return code_hash.hexdigest()
+
+
+def get_input_hashes(apk_dir_path, previous_inputs=None):
+    """
+    :param apk_dir_path: The path to the app subdirectory.
+    :param previous_inputs: The inputs of the previous manifest of the app, if any. The hash of a file whose size and
+                            modification time did not change is taken from it instead of reading the file again.
+    :return: The size, modification time and hash of each PCAP file of the app, by file name.
+    """
+    previous_inputs = previous_inputs or {}
+    inputs = {}
+    for fn in sorted(os.listdir(apk_dir_path)):
+        if not fn.startswith(PCAP_FILE_PREFIX) or not fn.endswith(PCAP_FILE_EXTENSION):
+            continue
+        stat = os.stat(os.path.join(apk_dir_path, fn))
+        previous = previous_inputs.get(fn, {})
+        if previous.get(json_key_size) == stat.st_size and previous.get(json_key_mtime) == stat.st_mtime_ns:
+            file_hash = previous[json_key_hash]
+        else:
+            file_hash = block_decision_store.get_file_hash(os.path.join(apk_dir_path, fn))
+        inputs[fn] = {json_key_size: stat.st_size, json_key_mtime: stat.st_mtime_ns, json_key_hash: file_hash}
+    return inputs
+
+
+def get_manifest(apk_dir_path, fl_matchers, options, previous_manifest=None):
+    """
+    :param apk_dir_path: The path to the app subdirectory.
+    :param fl_matchers: The filter list matchers the rows are annotated with.
+    :param options: The options of the pipeline that change the rows (a JSON-serializable dict).
+    :param previous_manifest: The previous manifest of the app, if any, to reuse the hashes of unchanged PCAP files.
+    :return: The manifest of the app.
+    """
+    previous_inputs = previous_manifest.get(json_key_inputs) if previous_manifest else None
+    return {json_key_inputs: get_input_hashes(apk_dir_path, previous_inputs),
+            json_key_filter_lists: [[fl_name, fl_matcher.rules_hash] for fl_name, fl_matcher in fl_matchers],
+            json_key_code: _get_code_hash(),
+            json_key_options: options}
+
+
+def is_unchanged(manifest, previous_manifest):
+    """
+    :return: True if the rows of the previous manifest are still valid for the manifest, False otherwise.
+    """
+    def without_times(inputs):
+        return {fn: input_hash[json_key_hash] for fn, input_hash in inputs.items()}
+
+    if previous_manifest is None:
+        return False
+    for key in [json_key_filter_lists, json_key_code, json_key_options]:
+        if manifest[key] != previous_manifest.get(key):
+            return False
+    # a PCAP file that was only touched is unchanged
+    return without_times(manifest[json_key_inputs]) == without_times(previous_manifest.get(json_key_inputs, {}))
+
+
+def read_manifest(manifest_file):
+    """
+    :return: The manifest, or None if there is none.
+    """
+    if not os.path.isfile(manifest_file):
+        return None
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except ValueError as e:
+        print("WARNING: could not read manifest: %s" % manifest_file)
+        print(e)
+        return None
+
+
+def write_manifest(manifest_file, manifest):
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=4)
+
+
+def read_rows(rows_file):
+    """
+    :return: The rows, or None if there are none.
+    """
+    if not os.path.isfile(rows_file):
+        return None
+    try:
+        with open(rows_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError as e:
+        print("WARNING: could not read rows: %s" % rows_file)
+        print(e)
+        return None
+
+
+def write_rows(rows_file, rows):
+    with open(rows_file, "w", encoding="utf-8") as f:
+        json.dump(rows, f)
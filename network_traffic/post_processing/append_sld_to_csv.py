@@ -1,10 +1,11 @@
 import unicodecsv as csv
 import argparse
-import tldextract
 
+import esld_resolver
 
-def _get_second_level_domain_from_tld(url_tld):
-    return url_tld.domain + "." + url_tld.suffix
+
+def get_second_level_domain(hostname):
+    return esld_resolver.get_resolver().get_second_level_domain(hostname)
 
 
 # =================== CSV column names ===================
@@ -14,6 +15,43 @@ keyset = [csv_key_hostname]
 # ========================================================
 
 
+def add_second_level_domains(df):
+    """
+    Adds the second level domain column to a DataFrame that has a hostname column. Each distinct hostname is resolved
+    once. Missing hostnames are treated as empty strings, like in the CSV files.
+    """
+    hostnames = df[csv_key_hostname].fillna("")
+    hostname_to_sld = {hostname: get_second_level_domain(hostname) for hostname in hostnames.unique()}
+    df[csv_key_sld_label] = hostnames.map(hostname_to_sld)
+    return df
+
+
+def append_sld_to_csv(in_csv, out_csv):
+    """
+    Writes the rows of the input CSV with the second level domain column appended, in a single pass over the input.
+    Each distinct hostname is resolved once.
+    """
+    hostname_to_sld = {}
+
+    with open(in_csv, "rb") as in_csv_file, open(out_csv, "wb") as out_csv_file:
+        csv_reader = csv.reader(in_csv_file, delimiter=",", quotechar='"')
+        csv_writer = csv.writer(out_csv_file, encoding="utf-8")
+
+        csv_header = next(csv_reader)
+        hostname_index = csv_header.index(csv_key_hostname)
+        csv_writer.writerow(csv_header + [csv_key_sld_label])
+
+        for row in csv_reader:
+            hostname = row[hostname_index]
+            sld = hostname_to_sld.get(hostname)
+            if sld is None:
+                sld = get_second_level_domain(hostname)
+                hostname_to_sld[hostname] = sld
+
+            row.append(sld)
+            csv_writer.writerow(row)
+
+
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(description="Given a csv with hostnames, we get the second level domain and append the information")
     ap.add_argument("in_csv", help="The expected column format and names should have " + str(keyset))
@@ -21,39 +59,4 @@ if __name__ == '__main__':
 
     args = ap.parse_args()
 
-    hostname_to_sld = {}
-
-    # Read data from CSV and create in-memory object representation of that data.
-    with open(args.in_csv, "rb") as in_csv_file:
-        csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
-        # row_num = 0
-        for row in csv_reader:
-            hostname = row[csv_key_hostname]
-
-
-            # turn hostname into sld
-            if hostname not in hostname_to_sld:
-                tldresult = tldextract.extract(hostname)
-                sld_new = _get_second_level_domain_from_tld(tldresult)
-                hostname_to_sld[hostname] = sld_new
-
-    # read in the file again to do the second time to label each row, and write it out as well
-    with open(args.in_csv, "rb") as in_csv_file:
-        csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
-
-        with open(args.out_csv, "wb") as out_csv_file:
-            csv_writer = csv.writer(out_csv_file, encoding="utf-8")
-            csv_header = csv_reader.fieldnames + [csv_key_sld_label]
-            csv_writer.writerow(csv_header)
-
-            # row_num = 0
-            for row in csv_reader:
-                hostname = row[csv_key_hostname]
-                sld = hostname_to_sld[hostname]
-                # put into array by header order (ignoring the last column, since that is second levle domain column)
-                data_row = [row[header_name] for header_name in csv_header[0:-1]]
-
-                #add sld
-                data_row.append(sld)
-                # write row
-                csv_writer.writerow(data_row)
+    append_sld_to_csv(args.in_csv, args.out_csv)
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark of the PII matching of pii_helper.py: compares PIIHelper.get_pii_from_str, which searches each PII value
+(and its hashes) with its own precompiled pattern after a lowercase substring check, with the previous implementation,
+which searched and redacted each of them with an uncompiled regular expression. The strings are synthetic, with PII
+values, nested and overlapping ones (e.g., "vr_device_model" or a runtime version that contains the truncated version),
+their hashes, and random text. Both must find and redact the same PII, with and without redacting.
+USAGE:
+$ python benchmark_pii_helper.py [--strings N] [--length L]
+"""
+
+import argparse
+import random
+import re
+import string
+import time
+
+import json_keys
+from pii_helper import PIIHelper
+
+
+def previous_get_pii_from_str(helper, value, override_redacting=False):
+    """
+    get_pii_from_str as it was before the patterns were compiled, without the URL decoding
+    """
+    pii_keys_found = []
+    updated_value = value
+    # redact from longer to shorter PII values
+    for pii_key, _ in sorted(helper.pii_dict.items(), key=lambda t: -len(t[1][0])):
+        updated_value, pii_found = helper._contains_pii(updated_value, pii_key, override_redacting=override_redacting)
+        if pii_found:
+            pii_keys_found.append(pii_key)
+
+    updated_value, location_found = helper._contains_location_pii_type(updated_value)
+    if location_found:
+        pii_keys_found.append(PIIHelper.PII_KEY_LOCATION)
+
+    return updated_value, pii_keys_found
+
+
+def make_strings(helper, count, length, seed=0):
+    """
+    :return: count strings of about length characters of random text and PII values, in random case
+    """
+    rnd = random.Random(seed)
+    # the PII values (and hashes) that match themselves, i.e., all but the regular expressions with classes or escapes
+    pii_values = [pii_value for pii_values in helper.pii_dict.values() for pii_value in pii_values
+                  if re.fullmatch(pii_value, pii_value, re.I)]
+    pii_values += ["vr_device_model", "26.0.0.40.502.274988282", "x-playeruid", "Unity 2019.4.12", "OculusQuest",
+                   "UnityPlayer/2019.4.12f1"]
+    text_chars = string.ascii_letters + string.digits + " =&:;,/-_\"{}"
+    strings = []
+    for _ in range(count):
+        parts = []
+        size = 0
+        while size < length:
+            if rnd.random() < 0.3:
+                part = rnd.choice(pii_values)
+                part = part.upper() if rnd.random() < 0.2 else part
+            else:
+                part = "".join(rnd.choice(text_chars) for _ in range(rnd.randint(1, 40)))
+            parts.append(part)
+            size += len(part)
+        strings.append("".join(parts))
+    return strings
+
+
+def run(get_pii_from_str, strings, override_redacting):
+    """
+    :return: a tuple (the results for the strings, the time it took in seconds)
+    """
+    start = time.perf_counter()
+    results = [get_pii_from_str(value, override_redacting=override_redacting) for value in strings]
+    return results, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Benchmarks the PII matching of PIIHelper")
+    ap.add_argument('--strings', type=int, default=200, help='Number of strings')
+    ap.add_argument('--length', type=int, default=3000, help='Length of each string, in characters')
+    args = ap.parse_args()
+
+    helper = PIIHelper(json_keys.PII_VALUES, json_keys.LOCATION_PII, should_redact=True)
+    strings = make_strings(helper, args.strings, args.length)
+    print("%d strings of %d characters, %d PII keys" % (args.strings, args.length, len(helper.pii_dict)))
+    for override_redacting, mode in [(False, "redact"), (True, "detect")]:
+        previous, previous_time = run(lambda value, **kwargs: previous_get_pii_from_str(helper, value, **kwargs),
+                                      strings, override_redacting)
+        current, current_time = run(lambda value, **kwargs: helper.get_pii_from_str(value, url_decoding=False,
+                                                                                    **kwargs),
+                                    strings, override_redacting)
+        if previous != current:
+            raise SystemExit("ERROR: the matchers do not give the same results (%s)" % mode)
+
+        print("%s: previous get_pii_from_str: %.3f s, current: %.3f s, speedup: %.1fx" %
+              (mode, previous_time, current_time, previous_time / current_time))
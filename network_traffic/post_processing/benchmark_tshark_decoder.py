@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+"""
+Micro-benchmark of the handling of duplicate keys when decoding tshark JSON: compares parse_object_pairs of
+extract_from_tshark.py with the previous implementation, which probed key_1, key_2, ... from 1 for every repeated key,
+on synthetic header-heavy packets. Both must decode the packets to the same objects.
+USAGE:
+$ python benchmark_tshark_decoder.py [--packets N] [--repeats R]
+"""
+
+import argparse
+import json
+import time
+from collections import OrderedDict
+
+import extract_from_tshark
+
+
+def previous_make_unique(key, dct):
+    counter = 0
+    unique_key = key
+
+    while unique_key in dct:
+        counter += 1
+        unique_key = key + "_" + str(counter)
+    return unique_key
+
+
+def previous_parse_object_pairs(pairs):
+    dct = OrderedDict()
+    for key, value in pairs:
+        if key in dct:
+            key = previous_make_unique(key, dct)
+        dct[key] = value
+
+    return dct
+
+
+def make_packets(packets, repeats):
+    """
+    :return: the text of a tshark JSON array of packets whose HTTP layer has the given number of request lines, and
+             whose TLS handshake has the given number of extensions, all with the same key.
+    """
+    tshark_packets = []
+    for i in range(packets):
+        http_lines = ", ".join('"http.request.line": "x-header-%d: value-%d\\r\\n"' % (j, i) for j in range(repeats))
+        extensions = ", ".join('"Extension: padding (len=%d)": {"tls.handshake.extension.len": "%d"}' % (j, j)
+                               for j in range(repeats))
+        tshark_packets.append('{"_source": {"layers": {"frame": {"frame.number": "%d"}, "http": {%s}, '
+                              '"tls": {"tls.record": {"tls.handshake": {%s}}}}}}' % (i, http_lines, extensions))
+    return "[" + ",\n".join(tshark_packets) + "]"
+
+
+def decode(text, object_pairs_hook):
+    """
+    :return: a tuple (the decoded packets, the time it took in seconds)
+    """
+    start = time.perf_counter()
+    decoded = json.loads(text, object_pairs_hook=object_pairs_hook)
+    return decoded, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Benchmarks the duplicate key handling of the tshark JSON decoder")
+    ap.add_argument('--packets', type=int, default=200, help='Number of packets')
+    ap.add_argument('--repeats', type=int, default=500,
+                    help='Number of repeated keys in the HTTP layer and in the TLS handshake of each packet')
+    args = ap.parse_args()
+
+    text = make_packets(args.packets, args.repeats)
+    previous, previous_time = decode(text, previous_parse_object_pairs)
+    current, current_time = decode(text, extract_from_tshark.parse_object_pairs)
+    if previous != current:
+        raise SystemExit("ERROR: the decoders do not give the same packets")
+
+    print("%d packets with %d repeated keys per object, %.1f MB" % (args.packets, args.repeats, len(text) / 1e6))
+    print("Previous parse_object_pairs: %.3f s" % previous_time)
+    print("Current parse_object_pairs:  %.3f s" % current_time)
+    print("Speedup: %.1fx" % (previous_time / current_time))
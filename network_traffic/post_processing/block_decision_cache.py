@@ -0,0 +1,165 @@
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+import hashlib
+import os
+import sqlite3
+import time
+
+
+class BlockDecisionCache(object):
+    """
+    On-disk cache of filter list block decisions, shared across runs (and processes) of the pipeline.
+    A decision is keyed by a hash of the filter list contents and of the URL and options it was made for, so that
+    editing a filter list invalidates only its own decisions. The least recently used decisions are evicted once the
+    cache holds more than max_entries of them. The number of decisions is kept up to date by triggers, so that it is
+    not counted again by each flush.
+    """
+
+    DEFAULT_MAX_ENTRIES = 5000000
+
+    def __init__(self, cache_file, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param cache_file: The path to the SQLite file of the cache. It is created if it does not exist.
+        :param max_entries: The maximum number of decisions kept in the cache.
+        """
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # decisions made since the last flush: (rules hash, url options hash) -> blocked
+        self.new_decisions = {}
+        # decisions found in the cache since the last flush
+        self.used_keys = set()
+        self.connection = None
+        self.pid = None
+
+    @staticmethod
+    def get_url_options_hash(url_options_key):
+        """
+        :param url_options_key: The URL and its options, as used by the in-memory cache of the filter list checker.
+        :return: The key of the URL and options in the cache.
+        """
+        return hashlib.sha1(url_options_key.encode("utf-8")).digest()
+
+    def _get_connection(self):
+        """
+        Opens the SQLite file, or reopens it in a forked worker process since connections cannot be shared with it.
+        """
+        if self.connection is None or self.pid != os.getpid():
+            cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+            os.makedirs(cache_dir, exist_ok=True)
+            self.connection = sqlite3.connect(self.cache_file, timeout=60)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # the tables are created by one process at a time
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS block_decisions ("
+                                    "rules_hash TEXT NOT NULL, url_options_hash BLOB NOT NULL, "
+                                    "blocked INTEGER NOT NULL, last_used REAL NOT NULL, "
+                                    "PRIMARY KEY (rules_hash, url_options_hash))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS block_decisions_last_used "
+                                    "ON block_decisions (last_used)")
+            # the number of decisions, counted once for a cache file without it
+            self.connection.execute("CREATE TABLE IF NOT EXISTS block_decision_count (entries INTEGER NOT NULL)")
+            self.connection.execute("INSERT INTO block_decision_count SELECT (SELECT COUNT(*) FROM block_decisions) "
+                                    "WHERE NOT EXISTS (SELECT 1 FROM block_decision_count)")
+            self.connection.execute("CREATE TRIGGER IF NOT EXISTS block_decisions_insert "
+                                    "AFTER INSERT ON block_decisions "
+                                    "BEGIN UPDATE block_decision_count SET entries = entries + 1; END")
+            self.connection.execute("CREATE TRIGGER IF NOT EXISTS block_decisions_delete "
+                                    "AFTER DELETE ON block_decisions "
+                                    "BEGIN UPDATE block_decision_count SET entries = entries - 1; END")
+            self.connection.commit()
+            self.pid = os.getpid()
+            # decisions of the parent process are flushed by the parent
+            self.new_decisions = {}
+            self.used_keys = set()
+        return self.connection
+
+    def get(self, rules_hash, url_options_key):
+        """
+        :return: The cached block decision of the filter list for the URL and options, or None if it is not cached.
+        """
+        key = (rules_hash, self.get_url_options_hash(url_options_key))
+        connection = self._get_connection()
+        blocked = self.new_decisions.get(key)
+        if blocked is None:
+            row = connection.execute("SELECT blocked FROM block_decisions WHERE rules_hash = ? AND url_options_hash = ?",
+                                     key).fetchone()
+            if row is not None:
+                blocked = bool(row[0])
+                self.used_keys.add(key)
+
+        if blocked is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return blocked
+
+    def put(self, rules_hash, url_options_key, blocked):
+        """
+        Adds a block decision to the cache. It is written to the file by the next flush.
+        """
+        self._get_connection()
+        self.new_decisions[(rules_hash, self.get_url_options_hash(url_options_key))] = blocked
+
+    def mark_used(self, keys):
+        """
+        Marks cached decisions as used, e.g., those found by a worker process, so that the next flush does not evict
+        them as least recently used.
+        :param keys: The (rules hash, url options hash) keys of the decisions, as in used_keys.
+        """
+        self._get_connection()
+        self.used_keys.update(keys)
+
+    def flush(self):
+        """
+        Writes the new decisions to the file, and evicts the least recently used ones if the cache is full.
+        """
+        connection = self._get_connection()
+        now = time.time()
+        with connection:
+            connection.executemany("UPDATE block_decisions SET last_used = ? "
+                                   "WHERE rules_hash = ? AND url_options_hash = ?",
+                                   [(now,) + key for key in self.used_keys])
+            # an upsert rather than INSERT OR REPLACE, whose implicit delete does not run the delete trigger
+            connection.executemany("INSERT INTO block_decisions VALUES (?, ?, ?, ?) "
+                                   "ON CONFLICT (rules_hash, url_options_hash) "
+                                   "DO UPDATE SET blocked = excluded.blocked, last_used = excluded.last_used",
+                                   [key + (int(blocked), now) for key, blocked in self.new_decisions.items()])
+            count = connection.execute("SELECT entries FROM block_decision_count").fetchone()[0]
+            if count > self.max_entries:
+                connection.execute("DELETE FROM block_decisions WHERE rowid IN "
+                                   "(SELECT rowid FROM block_decisions ORDER BY last_used LIMIT ?)",
+                                   (count - self.max_entries,))
+        self.new_decisions = {}
+        self.used_keys = set()
+
+    def close(self):
+        """
+        Flushes the new decisions and closes the file.
+        """
+        if self.connection is not None and self.pid == os.getpid():
+            self.flush()
+            self.connection.close()
+        self.connection = None
+
+    def get_stats(self, reset=False):
+        """
+        :param reset: Whether to reset the hit and miss counters.
+        :return: A summary of the hits and misses of the cache.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        stats = "Block decision cache %s: %d hits, %d misses (%.1f%% hit rate)" % (self.cache_file, self.hits,
+                                                                                  self.misses, hit_rate)
+        if reset:
+            self.hits = 0
+            self.misses = 0
+        return stats
@@ -0,0 +1,96 @@
+# This file is a part of OVRseen <https://athinagroup.eng.uci.edu/projects/ovrseen/>.
+# Copyright (c) 2021 UCI Networking Group.
+#
+# OVRseen is dual licensed under the MIT License and the GNU General Public
+# License version 3 (GPLv3). This file is covered by the GPLv3. If this file
+# get used, GPLv3 applies to all of OVRseen.
+#
+# See the LICENSE.md file along with OVRseen for more details.
+
+"""
+Stores the block decisions of each filter list for the packets of an annotated NoMoAds json file, in a decisions file
+next to it. The decisions of a filter list are kept with the hash of its rules, and all of them with the hash of the
+NoMoAds json file they were made for, so that only the filter lists that changed need to be evaluated again. The hash of
+the annotated NoMoAds json file is kept too, so that the decisions are not used for another annotated file (e.g., one
+written again since).
+"""
+
+import hashlib
+import json
+import os
+
+import nomoads_format
+
+DECISIONS_FILE_SUFFIX = "-decisions.json"
+
+json_key_source_hash = "source_hash"
+json_key_annotated_hash = "annotated_hash"
+json_key_filter_lists = "filter_lists"
+json_key_rules_hash = "rules_hash"
+json_key_decisions = "decisions"
+
+
+def get_decisions_file(annotated_file):
+    """
+    :param annotated_file: The path to an annotated NoMoAds json file.
+    :return: The path to the decisions file of the annotated NoMoAds json file.
+    """
+    return nomoads_format.strip_extension(annotated_file) + DECISIONS_FILE_SUFFIX
+
+
+def get_file_hash(path):
+    """
+    :return: The SHA-256 hash of the contents of a file.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_block_decisions(fl_matchers, nomoads_json):
+    """
+    :param fl_matchers: The filter list matchers that annotated the NoMoAds json.
+    :param nomoads_json: An in-memory representation of an annotated NoMoAds json file.
+    :return: The block decisions of each filter list, by filter list name.
+    """
+    return {fl_name: {json_key_rules_hash: fl_matcher.rules_hash,
+                      json_key_decisions: {key: nomoads_json[key][fl_name] for key in nomoads_json}}
+            for fl_name, fl_matcher in fl_matchers}
+
+
+def read_block_decisions(decisions_file, source_hash=None, annotated_hash=None):
+    """
+    :param decisions_file: The path to a decisions file.
+    :param source_hash: If given, the decisions are only returned if they were made for a NoMoAds json with this hash.
+    :param annotated_hash: If given, the decisions are only returned if they were stored with an annotated NoMoAds json
+                           with this hash.
+    :return: The block decisions of each filter list, by filter list name, or an empty dict if there are none.
+    """
+    if not os.path.isfile(decisions_file):
+        return {}
+    try:
+        with open(decisions_file, "r") as f:
+            stored = json.load(f)
+    except ValueError as e:
+        print("WARNING: could not read block decisions: %s" % decisions_file)
+        print(e)
+        return {}
+    if source_hash is not None and stored.get(json_key_source_hash) != source_hash:
+        return {}
+    if annotated_hash is not None and stored.get(json_key_annotated_hash) != annotated_hash:
+        return {}
+    return stored.get(json_key_filter_lists, {})
+
+
+def write_block_decisions(decisions_file, source_hash, block_decisions, annotated_hash=None):
+    """
+    :param decisions_file: The path to the decisions file.
+    :param source_hash: The hash of the NoMoAds json file the decisions were made for.
+    :param block_decisions: The block decisions of each filter list, as returned by get_block_decisions.
+    :param annotated_hash: The hash of the annotated NoMoAds json file the decisions are stored with.
+    """
+    with open(decisions_file, "w") as f:
+        json.dump({json_key_source_hash: source_hash, json_key_annotated_hash: annotated_hash,
+                   json_key_filter_lists: block_decisions}, f, sort_keys=True)
@@ -14,6 +14,8 @@ import glob
 # utils is in parent dir
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + os.sep + "..")
 from utils import utils
+import block_decision_store
+import nomoads_format
 
 json_key_protocol = "protocol"
 json_key_src_ip = "src_ip"
@@ -23,48 +25,157 @@ json_key_tcp_stream = "tcp.stream"
 json_key_pii_found = "pii_types"
 json_key_package_name = "package_name"
 json_key_http_body = "http.file_data"
+# Flow records (see extract_from_tshark.iter_tshark_flows)
+json_key_ts = "ts"
+json_key_last_ts = "last_ts"
+json_key_pkt_count = "pkt_count"
+json_key_urls = "urls"
+FLOW_KEYS = [json_key_ts, json_key_last_ts, json_key_pkt_count, json_key_urls]
 
 
 OCULUS = "oculus"
 ACCEPTED_FILE_NAMING_FORMATS = [OCULUS]
 
+FILE_SUFFIX = "-out-nomoads.json"
+# suffixes of the NoMoAds files in each of the formats of nomoads_format
+FILE_SUFFIXES = [nomoads_format.strip_extension(FILE_SUFFIX) + extension for extension in nomoads_format.EXTENSIONS]
+
+
+def get_filter_list_names(filter_list_dir):
+    """
+    Determine the json keys used for each filter list.
+    """
+    return [fl_name for fl_name, _ in utils.list_filter_lists(filter_list_dir)]
+
+
+def get_csv_header(filter_list_names, include_http_body=False, include_flow_fields=False):
+    blk = "_block_decision"
+    header_row = ["app_id",
+                  "pkt_id",
+                  json_key_protocol,
+                  json_key_src_ip,
+                  json_key_dst_ip,
+                  json_key_dst_port,
+                  "tcp_stream",
+                  "hostname",
+                  "path",
+                  "headers",
+                  json_key_pii_found,
+                  json_key_package_name]
+    if include_http_body:
+        header_row.append(json_key_http_body)
+    if include_flow_fields:
+        header_row.extend(FLOW_KEYS)
+
+    for fln in filter_list_names:
+        header_row.append(fln + blk)
+
+    return header_row
+
+
+def get_app_id(nomoads_file, format=OCULUS):
+    """
+    Derive the app id from the name of a NoMoAds json file, or None if the format is not supported.
+    """
+    if format == OCULUS:
+        # Assume filename format like "app.json"
+        app_id = os.path.basename(nomoads_file)
+        for file_suffix in FILE_SUFFIXES:
+            if app_id.endswith(file_suffix):
+                app_id = app_id[:-len(file_suffix)]
+                break
+        return app_id.replace("_", ".")
+    return None
+
+
+def get_pkt_id(app_id, key):
+    """
+    The packet ids of a NoMoAds json are only unique within the app (they count its packets from 0), so the pkt_id
+    column of the CSV rows is a composite key of the app id and the packet id, e.g., "com.example.app:12".
+    """
+    return "%s:%s" % (app_id, key)
+
+
+def get_block_decision_rows(app_id, filter_list_names, data, include_http_body=False, block_decisions=None,
+                            include_flow_fields=False):
+    """
+    Yields one CSV row (in the order of get_csv_header) for each packet of an annotated in-memory NoMoAds json, or of
+    an iterator of (packet id, packet) tuples as returned by nomoads_format.iter_packets.
+    If include_flow_fields is set, the packets are flow records, and a single packet is a flow of one packet.
+    The pkt_id column is unique across apps, see get_pkt_id.
+    The block decision of a filter list is taken from block_decisions (as read by
+    block_decision_store.read_block_decisions) if it has the filter list, and from the packet otherwise.
+    block_decisions must be those stored for this annotated NoMoAds json, since they are taken by packet id.
+    """
+    fl_decisions = []
+    for fl in filter_list_names:
+        if block_decisions and fl in block_decisions:
+            fl_decisions.append(block_decisions[fl][block_decision_store.json_key_decisions])
+        else:
+            fl_decisions.append(None)
+
+    packets = data.items() if isinstance(data, dict) else data
+    for key, pkt in packets:
+        protocol = pkt.get(json_key_protocol, "")
+
+        src_ip = pkt[json_key_src_ip]
+        dst_ip = pkt[json_key_dst_ip]
+        dst_port = pkt[json_key_dst_port]
+        tcp_stream = pkt[json_key_tcp_stream]
+        host = pkt.get(utils.json_key_host, "")
+        path = pkt.get(utils.json_key_uri, "")
+        piis_found = pkt.get(json_key_pii_found, "[]")
+        package_name = pkt.get(json_key_package_name, "")
+        # Keys are sorted like in the NoMoAds json files, so that in-memory packets give the same value
+        headers = json.dumps(pkt[utils.json_key_headers], sort_keys=True) if utils.json_key_headers in pkt else ""
+
+        row = [app_id,
+               get_pkt_id(app_id, key),
+               protocol,
+               src_ip,
+               dst_ip,
+               dst_port,
+               tcp_stream,
+               host,
+               path,
+               headers,
+               piis_found,
+               package_name]
+
+        if include_http_body:
+            row.append(pkt.get(json_key_http_body, ""))
+        if include_flow_fields:
+            row.extend([pkt.get(json_key_ts, ""),
+                        pkt.get(json_key_last_ts, pkt.get(json_key_ts, "")),
+                        pkt.get(json_key_pkt_count, 1),
+                        pkt.get(json_key_urls, [])])
+
+        for fl, decisions in zip(filter_list_names, fl_decisions):
+            row.append(pkt[fl] if decisions is None else decisions[key])
+        yield row
+
+
+def write_csv(csv_file, header_row, rows):
+    """
+    Writes a header row and the given rows to a CSV file.
+    """
+    with open(csv_file, "wb") as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(header_row)
+        csv_writer.writerows(rows)
+
 
-def write_block_decisions_to_csv(app_id, filter_list_names, full_path, csv_writer, include_http_body=False):
-    with open(full_path, "r") as jf:
-        data = json.load(jf)
-        for key in data:
-            pkt = data[key]
-            protocol = pkt.get(json_key_protocol, "")
-
-            src_ip = pkt[json_key_src_ip]
-            dst_ip = pkt[json_key_dst_ip]
-            dst_port = pkt[json_key_dst_port]
-            tcp_stream = pkt[json_key_tcp_stream]
-            host = pkt.get(utils.json_key_host, "")
-            path = pkt.get(utils.json_key_uri, "")
-            piis_found = pkt.get(json_key_pii_found, "[]")
-            package_name = pkt.get(json_key_package_name, "")
-            headers = json.dumps(pkt[utils.json_key_headers]) if utils.json_key_headers in pkt else ""
-
-            row = [app_id,
-                   key,
-                   protocol,
-                   src_ip,
-                   dst_ip,
-                   dst_port,
-                   tcp_stream,
-                   host,
-                   path,
-                   headers,
-                   piis_found,
-                   package_name]
-
-            if include_http_body:
-                row.append(pkt.get(json_key_http_body, ""))
-
-            for fl in filter_list_names:
-                row.append(pkt[fl])
-            csv_writer.writerow(row)
+def write_block_decisions_to_csv(app_id, filter_list_names, full_path, csv_writer, include_http_body=False,
+                                 include_flow_fields=False):
+    # the decisions of a decisions file left from another annotated file are ignored, and those of the packets used
+    block_decisions = block_decision_store.read_block_decisions(
+        block_decision_store.get_decisions_file(full_path),
+        annotated_hash=block_decision_store.get_file_hash(full_path))
+    # packets are read one at a time from line-delimited NoMoAds files
+    csv_writer.writerows(get_block_decision_rows(app_id, filter_list_names, nomoads_format.iter_packets(full_path),
+                                                 include_http_body=include_http_body,
+                                                 block_decisions=block_decisions,
+                                                 include_flow_fields=include_flow_fields))
 
 
 def file_naming_format(format):
@@ -90,61 +201,29 @@ if __name__ == '__main__':
                          default_file_naming_format + '.')
     ap.add_argument('--include_http_body', action="store_true",
                     help='Whether to include http body')
+    ap.add_argument('--flows', dest='include_flow_fields', action="store_true",
+                    help='Whether the NoMoAds json files have flow records (see extract_from_tshark.py --flows), to '
+                         'include their fields (first and last timestamps, packet count, URLs)')
     args = ap.parse_args()
 
     # Determine the json keys used for each filter list.
-    fl_names = []
-    for fl_file in os.listdir(args.filter_list_dir):
-        if "DS_Store" in fl_file:
-            continue
-        ext_start = fl_file.rfind(".")
-        if ext_start < 0:
-            print("WARNING: skipping filter list file '" + fl_file +
-                  "' as the filename does not contain a file extension.")
-            continue
-        # Name of filter list becomes filename minus file extension
-        fl_name = fl_file[0:ext_start]
-        if len(fl_file) > 0 and len(fl_name) > 0:
-            fl_names.append(fl_name)
-        else:
-            print("WARNING: skipping filter list file '" + fl_file +
-                  "' as the filename is empty before the file extension")
+    fl_names = get_filter_list_names(args.filter_list_dir)
 
     with open(args.csv_file, "wb") as f:
-        blk = "_block_decision"
-        header_row = ["app_id",
-                      "pkt_id",
-                      json_key_protocol,
-                      json_key_src_ip,
-                      json_key_dst_ip,
-                      json_key_dst_port,
-                      "tcp_stream",
-                      "hostname",
-                      "path",
-                      "headers",
-                      json_key_pii_found,
-                      json_key_package_name]
-        if args.include_http_body:
-            header_row.append(json_key_http_body)
-
-        for fln in fl_names:
-            header_row.append(fln + blk)
-
         csv_writer = csv.writer(f)
-        csv_writer.writerow(header_row)
-
-        FILE_SUFFIX = "-out-nomoads.json"
+        csv_writer.writerow(get_csv_header(fl_names, include_http_body=args.include_http_body,
+                                           include_flow_fields=args.include_flow_fields))
 
-        for fn in glob.iglob(args.dir + os.sep + "*" + FILE_SUFFIX):
+        nomoads_files = sorted(fn for file_suffix in FILE_SUFFIXES
+                               for fn in glob.iglob(args.dir + os.sep + "*" + file_suffix))
+        for fn in nomoads_files:
             if fn == ".DS_Store":
                 continue
-            if args.format == OCULUS:
-                # Assume filename format like "app.json"
-                app_id = os.path.basename(fn)
-                app_id = app_id.replace(FILE_SUFFIX,"").replace("_", ".")
-            else:
+            app_id = get_app_id(fn, format=args.format)
+            if app_id is None:
                 # This shouldn't happen
                 print("Error: format does not match")
                 sys.exit(-1)
             full_path = fn
-            write_block_decisions_to_csv(app_id, fl_names, full_path, csv_writer,include_http_body=args.include_http_body)
+            write_block_decisions_to_csv(app_id, fl_names, full_path, csv_writer,include_http_body=args.include_http_body,
+                                         include_flow_fields=args.include_flow_fields)
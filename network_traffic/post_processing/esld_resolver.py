@@ -0,0 +1,170 @@
+"""
+Resolves hostnames (and URLs) to their subdomain, domain, and public suffix, for the stages that compute eSLDs.
+The public suffix list is the snapshot bundled with tldextract (or a given suffix list file): it is never fetched over
+the network, so that the results do not depend on when and where the pipeline runs. The results are memoized in a
+bounded cache shared by all the stages of a process, which can be saved to a file and loaded by the next run.
+"""
+
+import json
+import os
+from collections import OrderedDict, namedtuple
+
+import tldextract
+
+# File the resolved eSLDs are kept in across runs, shared by the network traffic post-processing and PoliCheck
+DEFAULT_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "esld.json")
+
+
+class ExtractedDomain(namedtuple("ExtractedDomain", ["subdomain", "domain", "suffix"])):
+    """
+    The parts of a hostname, like tldextract.ExtractResult.
+    """
+    __slots__ = ()
+
+    @property
+    def registered_domain(self):
+        """
+        :return: The domain and suffix of the hostname (e.g. "example.co.uk"), or "" if it has no suffix (e.g. an IP).
+        """
+        if self.domain and self.suffix:
+            return self.domain + "." + self.suffix
+        return ""
+
+
+class ESLDResolver(object):
+    """
+    Memoizing resolver of hostnames to ExtractedDomain. The least recently used hostnames are evicted once the cache
+    holds more than max_entries of them.
+    """
+
+    DEFAULT_MAX_ENTRIES = 100000
+    # Saved caches of another format version or suffix list are ignored
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_file=None, max_entries=DEFAULT_MAX_ENTRIES, suffix_list_file=None):
+        """
+        :param cache_file: The path to the JSON file the cache is loaded from and saved to, or None to not keep the
+                           cache across runs.
+        :param max_entries: The maximum number of hostnames kept in the cache.
+        :param suffix_list_file: The path to a public suffix list file, or None to use the snapshot bundled with
+                                 tldextract.
+        """
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        if suffix_list_file is None:
+            self.suffix_list = "tldextract-" + tldextract.__version__
+            suffix_list_urls = ()
+        else:
+            suffix_list_file = os.path.abspath(suffix_list_file)
+            self.suffix_list = suffix_list_file
+            suffix_list_urls = ("file://" + suffix_list_file,)
+        # no disk cache and no suffix list URL: the suffix list is read from the snapshot (or file) once
+        self.extractor = tldextract.TLDExtract(cache_dir=None, suffix_list_urls=suffix_list_urls)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def extract(self, hostname):
+        """
+        :param hostname: A hostname or a URL.
+        :return: The ExtractedDomain of the hostname.
+        """
+        extracted = self.cache.get(hostname)
+        if extracted is not None:
+            self.hits += 1
+            self.cache.move_to_end(hostname)
+            return extracted
+
+        self.misses += 1
+        result = self.extractor(hostname)
+        extracted = ExtractedDomain(result.subdomain, result.domain, result.suffix)
+        self.cache[hostname] = extracted
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return extracted
+
+    def get_registered_domain(self, hostname):
+        """
+        :return: The registered domain of the hostname, or "" if it has none.
+        """
+        return self.extract(hostname).registered_domain
+
+    def get_second_level_domain(self, hostname):
+        """
+        :return: The domain and suffix of the hostname, joined by a "." even if one of them is empty.
+        """
+        extracted = self.extract(hostname)
+        return extracted.domain + "." + extracted.suffix
+
+    def load(self):
+        """
+        Loads the cache file, if there is one and it was saved with the same suffix list.
+        """
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as f:
+                saved = json.load(f)
+        except ValueError as e:
+            print("WARNING: could not read eSLD cache: %s" % self.cache_file)
+            print(e)
+            return
+        if saved.get("version") != ESLDResolver.CACHE_VERSION or saved.get("suffix_list") != self.suffix_list:
+            return
+        for hostname, parts in saved.get("hostnames", [])[-self.max_entries:]:
+            self.cache[hostname] = ExtractedDomain(*parts)
+
+    def save(self):
+        """
+        Saves the cache to the cache file, if there is one.
+        """
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        tmp_file = self.cache_file + ".%d.tmp" % os.getpid()
+        with open(tmp_file, "w") as f:
+            # least recently used first, like the cache
+            json.dump({"version": ESLDResolver.CACHE_VERSION, "suffix_list": self.suffix_list,
+                       "hostnames": [[hostname, list(parts)] for hostname, parts in self.cache.items()]}, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def get_stats(self):
+        """
+        :return: A summary of the hits and misses of the cache.
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "eSLD cache: %d hostnames, %d hits, %d misses (%.1f%% hit rate)" % (len(self.cache), self.hits,
+                                                                                    self.misses, hit_rate)
+
+
+# Resolver shared by the stages of this process
+resolver = None
+
+
+def init_resolver(cache_file=None, max_entries=ESLDResolver.DEFAULT_MAX_ENTRIES, suffix_list_file=None):
+    """
+    Creates the shared resolver, unless it has already been created with the same cache file.
+    :return: The shared resolver.
+    """
+    global resolver
+    if resolver is None or resolver.cache_file != cache_file:
+        resolver = ESLDResolver(cache_file, max_entries=max_entries, suffix_list_file=suffix_list_file)
+    return resolver
+
+
+def get_resolver():
+    """
+    :return: The shared resolver, created without a cache file if init_resolver has not been called.
+    """
+    if resolver is None:
+        return init_resolver()
+    return resolver
+
+
+def extract(hostname):
+    """
+    :return: The ExtractedDomain of the hostname, from the shared resolver.
+    """
+    return get_resolver().extract(hostname)
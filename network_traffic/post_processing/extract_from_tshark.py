@@ -19,49 +19,154 @@ tshark from PCAPNG format
 
 import os, sys
 import json
-import uuid
+import itertools
+import codecs
 import argparse
 
 from collections import OrderedDict
 
 from pii_helper import PIIHelper
 import json_keys
+import nomoads_format
+from packet_record import PacketRecord
 
-# Prepare PII helper
-pii_helper = PIIHelper(json_keys.PII_VALUES, json_keys.LOCATION_PII, should_redact=True)
+# Options of the bounded body scan of the PII helpers (see PIIHelper.get_pii_from_body), off unless
+# use_body_scan_mode is called
+body_scan_options = {"max_body_scan_bytes": None, "skip_binary_bodies": False}
 
-# set of tuples (src port, dst IP) of decrypted connections
-decrypted_tuples = set()
+# Prepare PII helper, for the PII of all headsets until a device profile is used
+pii_helpers = {json_keys.ALL_DEVICES: PIIHelper(json_keys.PII_VALUES, json_keys.LOCATION_PII, should_redact=True)}
+pii_helper = pii_helpers[json_keys.ALL_DEVICES]
 
+# Number of bytes read from the tshark JSON file at a time (grows while a single packet does not fit)
+TSHARK_READ_SIZE = 1 << 20
 
-def make_unique(key, dct):
-    counter = 0
+# Characters that may appear between two packets of the top-level tshark JSON array
+TSHARK_ARRAY_FILLER = " \t\r\n,["
+
+# Maximum number of distinct URLs kept in a flow record
+MAX_FLOW_URLS = 10
+
+
+def use_device_profile(device):
+    """
+    Makes the packets extracted next be scanned for the PII of the device (see json_keys.get_pii_values), with a PII
+    helper that is prepared once per device profile.
+    :param device: a device profile of json_keys.DEVICE_PROFILES
+    :return: the PII helper of the device
+    """
+    global pii_helper
+    if device not in pii_helpers:
+        pii_helpers[device] = PIIHelper(json_keys.get_pii_values(device), json_keys.LOCATION_PII, should_redact=True,
+                                        **body_scan_options)
+    pii_helper = pii_helpers[device]
+    return pii_helper
+
+
+def use_body_scan_mode(max_body_scan_bytes=None, skip_binary_bodies=False):
+    """
+    Sets the bounded body scan mode of the PII helpers for the packets extracted next. By default, whole bodies are
+    scanned like any other value.
+    :param max_body_scan_bytes: the number of bytes of an HTTP, websocket, or irc body that are kept and scanned, or
+        None to scan whole bodies
+    :param skip_binary_bodies: whether the binary chunks of bodies are redacted instead of being scanned
+    """
+    body_scan_options["max_body_scan_bytes"] = max_body_scan_bytes
+    body_scan_options["skip_binary_bodies"] = skip_binary_bodies
+    for helper in pii_helpers.values():
+        helper.max_body_scan_bytes = max_body_scan_bytes
+        helper.skip_binary_bodies = skip_binary_bodies
+
+
+def make_unique(key, dct, counter=0):
+    """
+    :param counter: the last suffix that was given to the key in dct, so that the suffixes up to it are not probed
+    :return: a tuple (the first of key, key_1, key_2, ... that is not in dct, its suffix)
+    """
     unique_key = key
 
     while unique_key in dct:
         counter += 1
         unique_key = key + "_" + str(counter)
-    return unique_key
+    return unique_key, counter
 
 
 def parse_object_pairs(pairs):
     dct = OrderedDict()
+    # Last suffix given to each repeated key of this object. The keys before it are all in dct (keys are never
+    # removed), so probing can resume from it: each repeated key takes O(1) instead of O(number of repeats).
+    counters = {}
     for key, value in pairs:
         if key in dct:
-            key = make_unique(key, dct)
+            unique_key, counters[key] = make_unique(key, dct, counters.get(key, 0))
+            key = unique_key
         dct[key] = value
 
     return dct
 
 
-def get_tcp_stream_number(pkt):
+def iter_tshark_layers(jf, read_size=TSHARK_READ_SIZE):
+    '''
+    Incrementally parse a tshark JSON file (the output of "tshark -T json"), one packet at a time.
+    Only the packet that is currently being decoded is kept in memory, so this also works on files that
+    are several GB large, or on a pipe that tshark is still writing to.
+    :param jf: a file object opened in binary mode that contains the tshark JSON array.
+    :param read_size: the number of bytes to read at a time.
+    :return: a generator of the _source.layers structure of each packet. Duplicate keys are made unique
+             the same way as parse_object_pairs does.
+    '''
+    # Since certain json 'keys' appear multiple times in our data, we have to make them
+    # unique first (we can't use regular json.load() or we lose some data points). From:
+    # https://stackoverflow.com/questions/29321677/python-json-parser-allow-duplicate-keys
+    decoder = json.JSONDecoder(object_pairs_hook=parse_object_pairs)
+    text_decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    buf = ""
+    pos = 0
+    eof = False
+    next_read_size = read_size
+    while True:
+        # Skip the array start, separators, and whitespace between two packets
+        while pos < len(buf) and buf[pos] in TSHARK_ARRAY_FILLER:
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+
+        packet = None
+        if pos < len(buf):
+            try:
+                packet, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+
+        if packet is not None:
+            next_read_size = read_size
+            yield packet[json_keys.source][json_keys.layers]
+            continue
+
+        if eof:
+            return
+
+        # The current packet is not complete yet: drop what was consumed and read more. The read size is doubled
+        # every time the packet is still incomplete so that huge packets are not re-parsed too many times.
+        chunk = jf.read(next_read_size)
+        if chunk:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+            next_read_size *= 2
+        else:
+            buf = buf[pos:] + text_decoder.decode(b"", final=True)
+            eof = True
+        pos = 0
+
+
+def get_tcp_stream_number(layers):
     '''
     Extract the TCP stream id/number assigned to this packet by tshark.
-    :param pkt: A packet in tshark json format.
+    :param layers: a packet data from the _source.layers structure in tshark json format.
     :return: The TCP stream id/number assigned by tshark to this packet, or None if the value is not present in the
              packet, e.g., the packet is not a TCP segment.
     '''
-    layers = pkt[json_keys.source][json_keys.layers]
     if json_keys.tcp not in layers:
         return None
     tcp_section = layers[json_keys.tcp]
@@ -126,14 +231,16 @@ def extract_http_pkt(layers, frame_num, include_http_body=False):
 
     # If there is a body, check it for PII. Since we don't save body data, we don't care about redacting it
     if json_keys.http_body in http_data:
-        redacted_http_body, pii_found_in_body = pii_helper.get_pii_from_str(http_data[json_keys.http_body])
+        redacted_http_body, pii_found_in_body, scanned_bytes = pii_helper.get_pii_from_body(
+            http_data[json_keys.http_body])
+        new_packet[json_keys.pii_scan_bytes] = scanned_bytes
         if include_http_body:
             new_packet[json_keys.http_body] = redacted_http_body
             new_packet[json_keys.http_body].strip()
         pii_found += pii_found_in_body
 
     # Find PII in the json data that we will share, make note of them, and redact them
-    redacted_packet, pii_found_in_headers = pii_helper.get_pii_from_data(new_packet)
+    redacted_packet, pii_found_in_headers = pii_helper.get_pii_from_data(new_packet, in_place=True)
     pii_found += pii_found_in_headers
 
     # Save the PII
@@ -206,7 +313,8 @@ def extract_other_pkt(layers, frame_num, include_http_body=False):
         json_data = json.dumps(layers[json_keys.irc])
 
     # Find PII values/keys
-    redacted_websocket_body, pii_found_in_body = pii_helper.get_pii_from_str(json_data)
+    redacted_websocket_body, pii_found_in_body, scanned_bytes = pii_helper.get_pii_from_body(json_data)
+    new_packet[json_keys.pii_scan_bytes] = scanned_bytes
     if include_http_body:
         new_packet[json_keys.http_body] = redacted_websocket_body
         new_packet[json_keys.http_body].strip()
@@ -217,16 +325,44 @@ def extract_other_pkt(layers, frame_num, include_http_body=False):
     return new_packet
 
 
-def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
-    with open(full_path, "rb") as jf:
-        # Since certain json 'keys' appear multiple times in our data, we have to make them
-        # unique first (we can't use regular json.load() or we lose some data points). From:
-        # https://stackoverflow.com/questions/29321677/python-json-parser-allow-duplicate-keys
-        decoder = json.JSONDecoder(object_pairs_hook=parse_object_pairs)
-        pcap_data = decoder.decode(jf.read().decode(errors='ignore'))
+def extract_from_tshark(full_path, data, is_decrypted, decrypted_tuples, include_http_body=False):
+    """
+    Extracts the packets of one tshark JSON file into data, with packet ids that follow those already in data.
+    :param decrypted_tuples: set of tuples (src port, dst IP) of decrypted connections. Filled when is_decrypted is
+           True, and used to skip the SNI of those connections otherwise.
+    """
+    for pkt_id, new_packet in iter_tshark_packets(full_path, is_decrypted, decrypted_tuples,
+                                                  include_http_body=include_http_body,
+                                                  pkt_ids=itertools.count(len(data))):
+        data[pkt_id] = new_packet
+
+
+def iter_tshark_packets(full_path, is_decrypted, decrypted_tuples, include_http_body=False, pkt_ids=None):
+    """
+    Extracts the packets of one tshark JSON file, one at a time.
+    :param decrypted_tuples: set of tuples (src port, dst IP) of decrypted connections. Filled when is_decrypted is
+           True, and used to skip the SNI of those connections otherwise.
+    :param pkt_ids: an iterator of the packet ids, shared by the tshark JSON files of an app so that the ids are
+           unique within the app (0, 1, 2, ... by default)
+    :return: a generator of (packet id, PacketRecord) tuples
+    """
+    # Create a unique key for each packet to keep consistent with ReCon: an increasing integer, since the rows of
+    # different apps are told apart by their app id
+    pkt_ids = itertools.count() if pkt_ids is None else pkt_ids
+    for _, new_packet in iter_tshark_flow_packets(full_path, is_decrypted, decrypted_tuples,
+                                                  include_http_body=include_http_body):
+        yield next(pkt_ids), new_packet
 
-        for packet in pcap_data:
-            layers = packet[json_keys.source][json_keys.layers]
+
+def iter_tshark_flow_packets(full_path, is_decrypted, decrypted_tuples, include_http_body=False):
+    """
+    Extracts the packets of one tshark JSON file, one at a time, with the key of their flow: the TCP stream number
+    assigned by tshark, or the tuple (src port, dst IP, dst port) if the packet has none.
+    :return: a generator of (flow key, PacketRecord) tuples
+    """
+    with open(full_path, "rb") as jf:
+        # Parse one packet at a time to keep memory bounded on long capture sessions
+        for layers in iter_tshark_layers(jf):
 
             # All captured traffic should have a frame + frame number, but check anyway
             frame_num = " Frame: "
@@ -292,7 +428,7 @@ def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
             new_packet[json_keys.dst_port] = dst_port
 
             # Extract the tcp stream id/number, if any
-            tcp_stream_id = get_tcp_stream_number(packet)
+            tcp_stream_id = get_tcp_stream_number(layers)
             if tcp_stream_id is not None:
                 new_packet[json_keys.tcpstream] = tcp_stream_id
 
@@ -322,40 +458,144 @@ def extract_from_tshark(full_path, data, is_decrypted, include_http_body=False):
 
             new_packet["ts"] = layers[json_keys.frame][json_keys.frame_ts]
 
-            # Create a unique key for each packet to keep consistent with ReCon
-            # Also good in case packets end up in different files
-            data[str(uuid.uuid4())] = new_packet
+            flow_key = tcp_stream_id if tcp_stream_id is not None else (src_port, dst_ip, dst_port)
+            yield flow_key, PacketRecord(new_packet)
+
+
+def get_url(pkt):
+    """
+    :return: the host and URI of a packet in NoMoAds format (only the host for TLS packets)
+    """
+    return pkt.get(json_keys.host, "") + pkt.get(json_keys.uri, "")
+
+
+def new_flow(pkt):
+    """
+    :return: a flow record that starts with the packet: the fields of the packet, and the flow fields
+    """
+    flow = pkt.copy()
+    flow[json_keys.flow_last_ts] = pkt["ts"]
+    flow[json_keys.flow_pkt_count] = 1
+    flow[json_keys.flow_urls] = [get_url(pkt)]
+    return flow
+
+
+def add_to_flow(flow, pkt, max_urls=MAX_FLOW_URLS):
+    """
+    Adds a packet to a flow record: the other fields of the record stay those of the first packet.
+    """
+    ts = pkt["ts"]
+    if float(ts) < float(flow["ts"]):
+        flow["ts"] = ts
+    if float(ts) > float(flow[json_keys.flow_last_ts]):
+        flow[json_keys.flow_last_ts] = ts
+    flow[json_keys.flow_pkt_count] += 1
+
+    if json_keys.pii_label in pkt:
+        pii_found = flow.setdefault(json_keys.pii_label, [])
+        pii_found.extend(pii for pii in pkt[json_keys.pii_label] if pii not in pii_found)
+    if json_keys.pii_scan_bytes in pkt:
+        flow[json_keys.pii_scan_bytes] = flow.get(json_keys.pii_scan_bytes, 0) + pkt[json_keys.pii_scan_bytes]
+
+    url = get_url(pkt)
+    urls = flow[json_keys.flow_urls]
+    if len(urls) < max_urls and url not in urls:
+        urls.append(url)
+
+
+def iter_tshark_flows(full_path, is_decrypted, decrypted_tuples, include_http_body=False, pkt_ids=None,
+                      max_urls=MAX_FLOW_URLS):
+    """
+    Extracts the packets of one tshark JSON file, aggregated into one record per flow (see iter_tshark_flow_packets).
+    A flow record has the fields of the first packet of the flow, except that:
+    - "ts" and "last_ts" are the timestamps of the first and last packets,
+    - "pkt_count" is the number of packets,
+    - "pii_types" is the union of the PII types of the packets,
+    - "pii_scan_bytes" is the number of body bytes of the packets that were scanned for PII,
+    - "urls" are the distinct URLs of the packets (at most max_urls of them).
+    Flows are kept in memory until the whole file is read, but only one record per flow.
+    :param pkt_ids: an iterator of the flow ids, like for iter_tshark_packets
+    :return: a generator of (flow id, flow record) tuples, in the order of the first packets of the flows
+    """
+    pkt_ids = itertools.count() if pkt_ids is None else pkt_ids
+    flows = {}
+    for flow_key, new_packet in iter_tshark_flow_packets(full_path, is_decrypted, decrypted_tuples,
+                                                         include_http_body=include_http_body):
+        flow = flows.get(flow_key)
+        if flow is None:
+            flows[flow_key] = new_flow(new_packet)
+        else:
+            add_to_flow(flow, new_packet, max_urls)
+
+    for flow in flows.values():
+        yield next(pkt_ids), flow
 
 
 def write_data(data, file_out, permission):
+    # Line-delimited NoMoAds files are written one packet at a time
+    if nomoads_format.is_line_delimited(file_out):
+        nomoads_format.write_packets(file_out, data.items(), mode=permission)
+        return
+
     # Write the new data
     with open(file_out, permission) as jf:
         # print json.dumps(data, sort_keys=True, indent=4)
         jf.seek(0)
-        jf.write(json.dumps(data, sort_keys=True, indent=4))
+        jf.write(json.dumps(nomoads_format.to_json_object(data.items()), sort_keys=True, indent=4))
         jf.truncate()
 
 
-def extract(tshark_file_enc, tshark_file_dec, out_file, **kwargs):
+def tshark_files_exist(tshark_file_enc, tshark_file_dec):
+    """
+    :return: True if there is at least one of the JSON packet traces, False otherwise
+    """
+    return os.path.isfile(tshark_file_enc) or os.path.isfile(tshark_file_dec)
+
+
+def extract_data(tshark_file_enc, tshark_file_dec, **kwargs):
     """
     Extracts only the needed information from provided JSON packet traces and labels them
-    :param tshark_file: JSON file containing data extracted via tshark
-    :param out_file: File to write results to
-    :return: True on success, False on failure
+    :param tshark_file_enc: JSON file containing encrypted data extracted via tshark
+    :param tshark_file_dec: JSON file containing decrypted data extracted via tshark
+    :return: the packets in NoMoAds format, or None on failure
     """
 
-    if not (os.path.isfile(tshark_file_enc) or os.path.isfile(tshark_file_dec)):
+    if not tshark_files_exist(tshark_file_enc, tshark_file_dec):
         print("ERROR: invalid argument")
-        return False
+        return None
 
     # Prepare new data structure for re-formatted JSON storage
-    data = {}
+    return dict(iter_packets(tshark_file_enc, tshark_file_dec, **kwargs))
+
+
+def iter_packets(tshark_file_enc, tshark_file_dec, aggregate_flows=False, **kwargs):
+    """
+    Extracts only the needed information from provided JSON packet traces and labels them, one packet at a time
+    :param tshark_file_enc: JSON file containing encrypted data extracted via tshark
+    :param tshark_file_dec: JSON file containing decrypted data extracted via tshark
+    :param aggregate_flows: whether to aggregate the packets into flow records (see iter_tshark_flows)
+    :return: a generator of (packet id, packet in NoMoAds format) tuples, or of (flow id, flow record) tuples
+    """
+    decrypted_tuples = set()
+    pkt_ids = itertools.count()
+    iter_file = iter_tshark_flows if aggregate_flows else iter_tshark_packets
 
     # Extract decrypted data first to know which connections were successfully decrypted
-    extract_from_tshark(tshark_file_dec, data, True, **kwargs)
+    yield from iter_file(tshark_file_dec, True, decrypted_tuples, pkt_ids=pkt_ids, **kwargs)
 
     # Extract encrypted data next
-    extract_from_tshark(tshark_file_enc, data, False, **kwargs)
+    yield from iter_file(tshark_file_enc, False, decrypted_tuples, pkt_ids=pkt_ids, **kwargs)
+
+
+def extract(tshark_file_enc, tshark_file_dec, out_file, **kwargs):
+    """
+    Extracts only the needed information from provided JSON packet traces, labels them, and writes them to out_file
+    :param out_file: File to write results to
+    :return: True on success, False on failure
+    """
+    data = extract_data(tshark_file_enc, tshark_file_dec, **kwargs)
+    if data is None:
+        return False
 
     write_data(data, out_file, "w")
 
@@ -369,9 +609,23 @@ if __name__ == '__main__':
     ap.add_argument('--dec_file', required=True,
                     help='Decrypted pcap')
     ap.add_argument('--out_file', required=True,
-                    help='Output file')
+                    help='Output file (line-delimited NoMoAds format if it ends with .jsonl or .jsonl.gz)')
     ap.add_argument('--include_http_body', action="store_true",
                     help='Whether to include http body')
+    ap.add_argument('--flows', action="store_true",
+                    help='Whether to aggregate the packets of each TCP connection into one flow record')
+    ap.add_argument('--device', choices=json_keys.DEVICE_PROFILES,
+                    help='Device profile whose PII to scan for (default: detected from the path of the pcaps, '
+                         'or all devices)')
+    ap.add_argument('--max_body_scan_bytes', type=int, nargs='?', const=PIIHelper.MAX_BODY_SCAN_BYTES,
+                    help='Only keep and scan this many bytes of each body (default without a value: %d)' %
+                         PIIHelper.MAX_BODY_SCAN_BYTES)
+    ap.add_argument('--skip_binary_bodies', action="store_true",
+                    help='Whether to redact the binary parts of bodies instead of scanning them')
     args = ap.parse_args()
 
-    extract(args.enc_file, args.dec_file, args.out_file, include_http_body=args.include_http_body)
+    use_body_scan_mode(args.max_body_scan_bytes, args.skip_binary_bodies)
+    use_device_profile(args.device or json_keys.get_device_profile(os.path.dirname(args.dec_file)))
+
+    extract(args.enc_file, args.dec_file, args.out_file, include_http_body=args.include_http_body,
+            aggregate_flows=args.flows)
@@ -1,17 +1,27 @@
 import os
 from adblockparser import AdblockRules
 import argparse
+import hashlib
 import json
+import pickle
 import re
 import glob
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlsplit
 
 from utils import utils
+from block_decision_cache import BlockDecisionCache
+import block_decision_store
+import nomoads_format
 
 key_referer = "referer"
 key_req_with = "x-requested-with"
 key_xml_http_req = "xmlhttprequest"
 
+# Distinct URLs (host and URI) of a flow record, see extract_from_tshark.iter_tshark_flows
+key_flow_urls = "urls"
+
 key_http = "http"
 key_https = "https"
 
@@ -31,16 +41,116 @@ re_html = re.compile("\.html?$", re.IGNORECASE)
 # The Android code also includes fonts, but based on https://adblockplus.org/en/filters#options
 # this is not a valid option in current ABP
 # re_font = re.compile("\.(?:ttf|woff)$", re.IGNORECASE)
+
+# Rules that only name a host (e.g., "||example.com" or "@@||example.com^"), without wildcards or options
+re_host_rule = re.compile(r"^(@@)?\|\|([\w.-]+)(\^)?$")
+# Scheme and authority of a URL, as matched by the "||" rule prefix of adblockparser
+re_url_authority = re.compile(r"^(?:([^:/?#]+):)?(?://([^/?#]*))?")
+# Characters that are not an ABP separator ("^")
+re_not_separator = re.compile(r"[\w\-.%]")
+
+
+class HybridAdblockRules(object):
+    """
+    Makes the same block decisions as an AdblockRules instance initialized with the same rules, but looks up rules that
+    only name a host in a hash table, instead of compiling them into a single regex matched against every URL. Only
+    the remaining rules are passed to AdblockRules. Their exception rules are also kept, as blocking rules, in an
+    AdblockRules of their own, to check whether they allow a URL that a host rule blocks.
+    """
+
+    # Version of the serialized form of the rules; change it whenever the attributes change
+    PICKLE_VERSION = 2
+
+    def __init__(self, rules):
+        """
+        :param rules: The lines of a filter list in EasyList (ABP) format.
+        """
+        rules = list(rules)
+        # identifies the rules in the persistent block decision cache
+        self.rules_hash = hashlib.sha256("".join(rules).encode("utf-8")).hexdigest()
+
+        # host -> True if the rule requires a separator after the host ("||host^"), False otherwise
+        self.blacklisted_hosts = {}
+        self.whitelisted_hosts = {}
+        other_rules = []
+        for rule in rules:
+            host_rule = re_host_rule.match(rule.strip())
+            if host_rule is None:
+                other_rules.append(rule)
+                continue
+            is_exception, host, separator = host_rule.groups()
+            hosts = self.whitelisted_hosts if is_exception else self.blacklisted_hosts
+            host = host.lower()
+            hosts[host] = hosts.get(host, True) and separator is not None
+
+        # lengths of the hosts, to look up the prefixes of a URL that could match them
+        self.blacklisted_host_lengths = sorted(set(len(host) for host in self.blacklisted_hosts))
+        self.whitelisted_host_lengths = sorted(set(len(host) for host in self.whitelisted_hosts))
+        self.rules = AdblockRules(other_rules)
+        self.whitelist_rules = AdblockRules([rule.strip()[len("@@"):] for rule in other_rules
+                                             if rule.strip().startswith("@@")])
+
+    @staticmethod
+    def _get_host_rule_starts(url):
+        """
+        Returns the positions in the URL where a "||" rule may start matching: the beginning of the URL, after the
+        scheme, and the beginning of each label of the authority.
+        """
+        starts = [0]
+        url_authority = re_url_authority.match(url)
+        if url_authority.group(1) is not None:
+            starts.append(url_authority.end(1) + 1)
+        if url_authority.group(2) is not None:
+            authority_start = url_authority.start(2)
+            starts.append(authority_start)
+            starts.extend(authority_start + i + 1 for i, c in enumerate(url_authority.group(2)) if c == ".")
+        return starts
+
+    @staticmethod
+    def _matches_host_rule(url, starts, hosts, host_lengths):
+        """
+        :param url: The lower-cased URL.
+        :return: True if any of the host rules matches the URL, False otherwise.
+        """
+        for start in starts:
+            for length in host_lengths:
+                end = start + length
+                if end > len(url):
+                    break
+                requires_separator = hosts.get(url[start:end])
+                if requires_separator is None:
+                    continue
+                if not requires_separator or end == len(url) or not re_not_separator.match(url[end]):
+                    return True
+        return False
+
+    def should_block(self, url, options=None):
+        """
+        :param url: The full URL including query and fragment
+        :param options: The AdblockPlus options, as returned by get_options
+        :return: True if the rules block the URL, False otherwise.
+        """
+        options = options or {}
+        lower_url = url.lower()
+        starts = self._get_host_rule_starts(lower_url)
+        if self._matches_host_rule(lower_url, starts, self.whitelisted_hosts, self.whitelisted_host_lengths):
+            return False
+        if self._matches_host_rule(lower_url, starts, self.blacklisted_hosts, self.blacklisted_host_lengths):
+            # a more specific exception rule may still allow the URL
+            return not self.whitelist_rules.should_block(url, options)
+        return self.rules.should_block(url, options)
+
+
 def init_rule_checker(filter_list_file):
     """
-    Initializer an AdblockRules instance to correspond to a filter list stored in a given file.
+    Initializer a HybridAdblockRules instance to correspond to a filter list stored in a given file.
     :param filter_list_file: The path to the filter list file.
-    :return: An AdblockRules instance initialized to perform matching against the given filter list.
+    :return: A HybridAdblockRules instance initialized to perform matching against the given filter list.
     """
     print("Reading in filter list: %s" % filter_list_file)
     with open(filter_list_file, "r") as f:
         lines = f.readlines()
-        return AdblockRules(lines)
+        return HybridAdblockRules(lines)
 
 
 def get_content_type(url_parsed):
@@ -122,19 +232,25 @@ def get_options(url, httpheaders):
     return {content_type: True, 'xmlhttprequest': is_xml_request, 'third-party': is_third_party}
 
 
-def get_url_and_options(pkt_nomoads_json):
+def get_url_and_options(pkt_nomoads_json, host_and_uri=None):
+    """
+    :param host_and_uri: The host and URI of the request, those of the packet by default (e.g., one of the URLs of a
+        flow record).
+    :return: a tuple - (the full URL of the request, its AdblockPlus options)
+    """
     port = pkt_nomoads_json[utils.json_key_dst_port]
+    if host_and_uri is None:
+        host_and_uri = pkt_nomoads_json[utils.json_key_host] + pkt_nomoads_json.get(utils.json_key_uri, "")
 
     # Note: usually we only deal with HTTP/S:
     url = ""
-    if not pkt_nomoads_json[utils.json_key_host].startswith("http://") and \
-            not pkt_nomoads_json[utils.json_key_host].startswith("https://"):
+    if not host_and_uri.startswith("http://") and not host_and_uri.startswith("https://"):
         if port == 443:
             url = "https://"
         else:
             url = "http://"
 
-    url += pkt_nomoads_json[utils.json_key_host] + pkt_nomoads_json.get(utils.json_key_uri, "")
+    url += host_and_uri
     headers = pkt_nomoads_json.get(utils.json_key_headers, {})
     options = get_options(url, headers)
 
@@ -144,7 +260,7 @@ def get_url_and_options(pkt_nomoads_json):
 def get_block_decision(ruleset, pkt_nomoads_json, url, options):
     """
     Given a single packet in NoMoAds JSON format, return if the given filter list blocks that packet.
-    :param ruleset: an AdblockRules instance that has been initialized with a given set of rules.
+    :param ruleset: a HybridAdblockRules instance that has been initialized with a given set of rules.
     :param pkt_nomoads_json: A single packet in NoMoAds JSON format.
     :return: True if the ruleset would block the packet, False otherwise.
     """
@@ -162,10 +278,7 @@ def read_nomoads_json(nomoads_json_file):
     :param nomoads_json_file: The full path to the NoMoAds json file.
     :return: The in-memory representation of the json file.
     """
-    with open(nomoads_json_file, "r") as jf:
-        #decoder = json.JSONDecoder()
-        #return decoder.decode(jf.read())
-        return json.load(jf)
+    return nomoads_format.read_packets(nomoads_json_file)
 
 
 def read_and_annotate_nomoads_json(ruleset, nomoads_json_file, filter_list_name):
@@ -178,48 +291,150 @@ def read_and_annotate_nomoads_json(ruleset, nomoads_json_file, filter_list_name)
     :param filter_list_name: The key that will point to the block decision in the annotated json.
     :return: The original JSON, annotated with blocking decision and filter list name.
     """
-    with open(nomoads_json_file, "r") as jf:
-        decoder = json.JSONDecoder()
-        root_obj = decoder.decode(jf.read())
-        return annotate_nomoads_json(ruleset, root_obj, filter_list_name)
+    return annotate_nomoads_json(ruleset, read_nomoads_json(nomoads_json_file), filter_list_name)
 
 
 block_decision_cache = dict()
 
-def annotate_nomoads_json(ruleset, nomoads_json, filter_list_name):
+
+def get_cached_block_decision(ruleset, pkt, url, options, url_options_key, filter_list_name, decision_cache=None):
+    """
+    Returns the block decision of a filter list for a packet with a host, from the caches if possible.
+    :param url_options_key: The key of the URL and options in the caches.
+    :param decision_cache: An optional BlockDecisionCache that keeps the block decisions across runs.
+    :return: True if the ruleset would block the packet, False otherwise.
+    """
+    fl_block_decision_cache = block_decision_cache.setdefault(filter_list_name, dict())
+    if url_options_key in fl_block_decision_cache:
+        return fl_block_decision_cache[url_options_key]
+
+    blocked = None
+    if decision_cache is not None:
+        blocked = decision_cache.get(ruleset.rules_hash, url_options_key)
+    if blocked is None:
+        blocked = get_block_decision(ruleset, pkt, url, options)
+        if decision_cache is not None:
+            decision_cache.put(ruleset.rules_hash, url_options_key, blocked)
+    # add to cache
+    fl_block_decision_cache[url_options_key] = blocked
+    return blocked
+
+
+def annotate_packet(fl_matchers, pkt, decision_cache=None):
+    """
+    Annotates a single packet in NoMoAds JSON format with the block decision of every filter list. A flow record is
+    blocked if any of its URLs is, each with the headers of the record (those of the first packet of the flow).
+    :param fl_matchers: The filter list matchers, as returned by init_fl_matchers.
+    :param pkt: A single packet in NoMoAds JSON format.
+    :param decision_cache: An optional BlockDecisionCache that keeps the block decisions across runs.
+    :return: The packet, annotated with block decisions.
+    """
+    if utils.json_key_host not in pkt:
+        for fl_name, _ in fl_matchers:
+            pkt[fl_name] = 0
+        return pkt
+
+    urls_and_options = [get_url_and_options(pkt, host_and_uri) for host_and_uri in pkt.get(key_flow_urls) or [None]]
+    url_options_keys = [url + json.dumps(options, sort_keys=True) for url, options in urls_and_options]
+    for fl_name, fl_matcher in fl_matchers:
+        blocked = any(get_cached_block_decision(fl_matcher, pkt, url, options, url_options_key, fl_name,
+                                                decision_cache=decision_cache)
+                      for (url, options), url_options_key in zip(urls_and_options, url_options_keys))
+        pkt[fl_name] = 1 if blocked else 0
+    return pkt
+
+
+def annotate_packets(fl_matchers, packets, decision_cache=None):
+    """
+    Annotates packets in NoMoAds JSON format with the block decision of every filter list, one at a time.
+    :param fl_matchers: The filter list matchers, as returned by init_fl_matchers.
+    :param packets: An iterable of (packet id, packet) tuples.
+    :param decision_cache: An optional BlockDecisionCache that keeps the block decisions across runs.
+    :return: A generator of (packet id, annotated packet) tuples.
+    """
+    for key, pkt in packets:
+        yield key, annotate_packet(fl_matchers, pkt, decision_cache=decision_cache)
+
+
+def annotate_nomoads_json(ruleset, nomoads_json, filter_list_name, decision_cache=None):
     """
     Given an in-memory representation of a NoMoAds json file, annotates each packet with the given AdblockRules' block
     decision. The filter_list_name parameter defines the key that will point to the block decision.
-    :param ruleset: An AdblockRules instance that determines if each individual packet should be blocked or not.
+    :param ruleset: A HybridAdblockRules instance that determines if each individual packet should be blocked or not.
     :param nomoads_json: An in-memory representation of a NoMoAds json file.
     :param filter_list_name: The key that will point to the block decision in the annotated json.
+    :param decision_cache: An optional BlockDecisionCache that keeps the block decisions across runs.
     :return: The original JSON, annotated with block decision.
     """
-    if filter_list_name not in block_decision_cache:
-        block_decision_cache[filter_list_name] = dict()
-
     annotated = {}
     for key in nomoads_json:
-        pkt = nomoads_json[key]
-        if utils.json_key_host in pkt:
-            url, options = get_url_and_options(pkt)
-            url_options_key = url + json.dumps(options, sort_keys=True)
-            if url_options_key in block_decision_cache[filter_list_name]:
-                blocked = block_decision_cache[filter_list_name][url_options_key]
-                #print("Found in cache: ", url_options_key)
+        annotated[key] = annotate_packet([(filter_list_name, ruleset)], nomoads_json[key],
+                                         decision_cache=decision_cache)
+    return annotated
+
+
+def load_rule_checker(filter_list_file, rules_cache_dir):
+    """
+    Loads the HybridAdblockRules instance of a filter list from the cache directory, or parses the filter list and saves
+    its rules there. The rules are keyed by the hash of the filter list file, so an edited filter list is parsed again.
+    :param filter_list_file: The path to the filter list file.
+    :param rules_cache_dir: The directory of the parsed filter lists.
+    :return: A HybridAdblockRules instance initialized to perform matching against the given filter list.
+    """
+    with open(filter_list_file, "rb") as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()
+    cache_file = os.path.join(rules_cache_dir, "%s-%s-v%d.pickle" % (os.path.basename(filter_list_file), file_hash,
+                                                                     HybridAdblockRules.PICKLE_VERSION))
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            print("Could not load parsed filter list: %s" % cache_file)
+            print(e)
+
+    ruleset = init_rule_checker(filter_list_file)
+    os.makedirs(rules_cache_dir, exist_ok=True)
+    # write to a temporary file first, so that concurrent runs never load a partially written file
+    tmp_cache_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(tmp_cache_file, "wb") as f:
+        pickle.dump(ruleset, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_cache_file, cache_file)
+    return ruleset
+
+
+def init_fl_matchers(filter_list_dir, rules_cache_dir=None):
+    """
+    Prepare a filter list matcher for each filter list in a directory.
+    :param filter_list_dir: Path to a directory containing filter lists in EasyList (ABP) format.
+    :param rules_cache_dir: An optional directory where the parsed filter lists are kept across runs.
+    :return: A list that contains a tuple for each filter list, with the first element being the name and the second
+        element the matcher object.
+    """
+    fl_matchers = []
+    for fl_name, fl_path in utils.list_filter_lists(filter_list_dir):
+        try:
+            if rules_cache_dir is None:
+                fl_matchers.append((fl_name, init_rule_checker(fl_path)))
             else:
-                blocked = get_block_decision(ruleset, pkt, url, options)
-                # add to cache
-                url_options_key = url + json.dumps(options, sort_keys=True)
-                block_decision_cache[filter_list_name][url_options_key] = blocked
-        else:
-            blocked = False
-            #print("Warning, pkt has no ", utils.json_key_host, ", defaulting to blocked = False\n", str(pkt))
+                fl_matchers.append((fl_name, load_rule_checker(fl_path, rules_cache_dir)))
+        except Exception as e:
+            print("Could not parse rule file: %s" % fl_path)
+            print(e)
+    return fl_matchers
 
-        pkt[filter_list_name] = 1 if blocked else 0
-        annotated[key] = pkt
 
-    return annotated
+def annotate_with_all_filter_lists(fl_matchers, nomoads_json, decision_cache=None):
+    """
+    Annotates each packet of an in-memory NoMoAds json with the block decision of every filter list.
+    :param fl_matchers: The filter list matchers, as returned by init_fl_matchers.
+    :param nomoads_json: An in-memory representation of a NoMoAds json file.
+    :param decision_cache: An optional BlockDecisionCache that keeps the block decisions across runs.
+    :return: The original JSON, annotated with block decisions.
+    """
+    for fl_name, fl_matcher in fl_matchers:
+        nomoads_json = annotate_nomoads_json(fl_matcher, nomoads_json, fl_name, decision_cache=decision_cache)
+    return nomoads_json
 
 
 def write_annotated_nomoads_json(data, file_out):
@@ -228,12 +443,130 @@ def write_annotated_nomoads_json(data, file_out):
     :param data: The annotated NoMoAds JSON.
     :param file_out: The file to output the annotated NoMoAds JSON to.
     """
+    if nomoads_format.is_line_delimited(file_out):
+        nomoads_format.write_packets(file_out, data.items())
+        return
     with open(file_out, "w") as jf:
         jf.seek(0)
-        jf.write(json.dumps(data, sort_keys=True, indent=4))
+        jf.write(json.dumps(nomoads_format.to_json_object(data.items()), sort_keys=True, indent=4))
         jf.truncate()
 
 
+def annotate_nomoads_file(fl_matchers, nomoads_path, out_dir_name, decision_cache=None):
+    """
+    Annotates a NoMoAds json file with the block decision of every filter list, and writes the result to the given
+    inner directory of the directory of the file, along with the decisions file of block_decision_store. The filter
+    lists whose decisions are already in the decisions file (for the same rules and NoMoAds json file) are not
+    evaluated again, and nothing is written if none of them changed.
+    :param fl_matchers: The filter list matchers, as returned by init_fl_matchers.
+    :param nomoads_path: The full path to the NoMoAds json file.
+    :param out_dir_name: Name of the inner directory we want to save the file to.
+    :param decision_cache: An optional BlockDecisionCache that keeps the block decisions across runs.
+    """
+    fl_result_dir = os.path.join(os.path.dirname(nomoads_path), out_dir_name)
+    annotated_path = fl_result_dir + os.sep + os.path.basename(nomoads_path)
+    decisions_path = block_decision_store.get_decisions_file(annotated_path)
+
+    source_hash = block_decision_store.get_file_hash(nomoads_path)
+    stored_decisions = {}
+    if os.path.isfile(annotated_path):
+        stored_decisions = block_decision_store.read_block_decisions(
+            decisions_path, source_hash=source_hash,
+            annotated_hash=block_decision_store.get_file_hash(annotated_path))
+    changed_fl_matchers = [(fl_name, fl_matcher) for fl_name, fl_matcher in fl_matchers
+                           if stored_decisions.get(fl_name, {}).get(block_decision_store.json_key_rules_hash)
+                           != fl_matcher.rules_hash]
+    if not changed_fl_matchers and len(stored_decisions) == len(fl_matchers):
+        print("Block decisions are up to date: ", annotated_path)
+        return
+
+    # Perform rule matching for the filter lists that changed, and reuse the decisions of the others.
+    # Packets are read, annotated, and written one at a time if the NoMoAds file is line-delimited.
+    changed_fl_names = set(fl_name for fl_name, _ in changed_fl_matchers)
+    block_decisions = {fl_name: {block_decision_store.json_key_rules_hash: fl_matcher.rules_hash,
+                                 block_decision_store.json_key_decisions: {}}
+                       for fl_name, fl_matcher in fl_matchers}
+
+    def annotated_packets():
+        for key, pkt in nomoads_format.iter_packets(nomoads_path):
+            annotate_packet(changed_fl_matchers, pkt, decision_cache=decision_cache)
+            for fl_name, _ in fl_matchers:
+                if fl_name not in changed_fl_names:
+                    pkt[fl_name] = stored_decisions[fl_name][block_decision_store.json_key_decisions].get(key, 0)
+                block_decisions[fl_name][block_decision_store.json_key_decisions][key] = pkt[fl_name]
+            yield key, pkt
+
+    # make the output directory
+    if not os.path.isdir(fl_result_dir):
+        os.makedirs(fl_result_dir, exist_ok=True)
+    # Json has now been annotated with blocking decisions for all filter lists. Write result to output dir.
+    nomoads_format.write_packets(annotated_path, annotated_packets())
+    block_decision_store.write_block_decisions(decisions_path, source_hash, block_decisions,
+                                               annotated_hash=block_decision_store.get_file_hash(annotated_path))
+
+
+# Arguments of the worker processes of annotate_nomoads_files, set before they are forked
+worker_args = {}
+
+
+def _annotate_nomoads_file_in_worker(nomoads_path):
+    """
+    Annotates a NoMoAds json file in a worker process of annotate_nomoads_files.
+    :return: A tuple - (the block decisions made for the file, per filter list name, as lists of (url options key,
+        blocked) tuples, the keys of the decisions found in the decision cache, the hits of the decision cache, the
+        misses of the decision cache).
+    """
+    print("Annotating nomoads json ", nomoads_path)
+    decision_cache = worker_args["decision_cache"]
+    # block_decision_cache keeps the insertion order, so the new decisions are the ones after the current ones
+    cache_sizes = {fl_name: len(block_decision_cache.get(fl_name, {})) for fl_name, _ in worker_args["fl_matchers"]}
+    hits, misses = (decision_cache.hits, decision_cache.misses) if decision_cache is not None else (0, 0)
+
+    annotate_nomoads_file(worker_args["fl_matchers"], nomoads_path, worker_args["out_dir_name"],
+                          decision_cache=decision_cache)
+
+    new_decisions = {fl_name: list(block_decision_cache.get(fl_name, {}).items())[cache_size:]
+                     for fl_name, cache_size in cache_sizes.items()}
+    used_keys = set()
+    if decision_cache is not None:
+        hits, misses = decision_cache.hits - hits, decision_cache.misses - misses
+        # the worker never flushes the decision cache, so the parent refreshes the decisions that were used
+        used_keys, decision_cache.used_keys = decision_cache.used_keys, set()
+    return new_decisions, used_keys, hits, misses
+
+
+def annotate_nomoads_files(fl_matchers, nomoads_paths, out_dir_name, jobs=1, decision_cache=None):
+    """
+    Annotates NoMoAds json files with the block decision of every filter list, see annotate_nomoads_file.
+    With more than one job, the files are distributed across forked worker processes, which share the filter list
+    matchers of this process. The block decisions made by the workers are then merged into the caches of this process,
+    and the cached decisions they used are marked as used.
+    :param jobs: The number of files annotated concurrently.
+    """
+    if jobs <= 1 or len(nomoads_paths) <= 1:
+        for nomoads_path in nomoads_paths:
+            annotate_nomoads_file(fl_matchers, nomoads_path, out_dir_name, decision_cache=decision_cache)
+        return
+
+    worker_args.update(fl_matchers=fl_matchers, out_dir_name=out_dir_name, decision_cache=decision_cache)
+    fl_rules_hashes = {fl_name: fl_matcher.rules_hash for fl_name, fl_matcher in fl_matchers}
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+            for new_decisions, used_keys, hits, misses in executor.map(_annotate_nomoads_file_in_worker,
+                                                                       nomoads_paths):
+                for fl_name, decisions in new_decisions.items():
+                    block_decision_cache.setdefault(fl_name, dict()).update(decisions)
+                    if decision_cache is not None:
+                        for url_options_key, blocked in decisions:
+                            decision_cache.put(fl_rules_hashes[fl_name], url_options_key, blocked)
+                if decision_cache is not None:
+                    decision_cache.mark_used(used_keys)
+                    decision_cache.hits += hits
+                    decision_cache.misses += misses
+    finally:
+        worker_args.clear()
+
+
 if __name__ == '__main__':
     ap = argparse.ArgumentParser(description="Match packet data against a given set of filter lists.")
     ap.add_argument('nomoads_dirs', type=utils.readable_dirs,
@@ -242,33 +575,24 @@ if __name__ == '__main__':
                     help='Path to a directory containing filter lists in EasyList (ABP) format.')
     ap.add_argument('out_dir_name', type=str,
                     help='Name of the inner directory we want to save the file to.')
+    ap.add_argument('--decision_cache', type=str, default=None,
+                    help='SQLite file that keeps the block decisions across runs.')
+    ap.add_argument('--rules_cache_dir', type=str, default=None,
+                    help='Directory where the parsed filter lists are kept across runs.')
+    ap.add_argument('--jobs', type=int, default=1,
+                    help='Number of NoMoAds JSON files annotated concurrently.')
     args = ap.parse_args()
 
-    # Prepare a filter list matcher for each filter list. List will contain a tuple for each filter list, with the first
-    # element being the name and the second element the matcher object.
-    fl_matchers = []
-    for fl_file in os.listdir(args.filter_list_dir):
-        if "DS_Store" in fl_file:
-            continue
-        fl_path = args.filter_list_dir + "/" + fl_file
-        ext_start = fl_file.rfind(".")
-        if ext_start < 0:
-            print("WARNING: skipping filter list file '" + fl_file +
-                  "' as the filename does not contain a file extension.")
-            continue
-        # Name of filter list becomes filename minus file extension
-        fl_name = fl_file[0:ext_start]
-        if len(fl_file) > 0:
-            try:
-                fl_matchers.append((fl_name, init_rule_checker(fl_path)))
-            except Exception as e:
-                print("Could not parse rule file: %s" % fl_path)
-                print(e)
+    # Prepare a filter list matcher for each filter list.
+    fl_matchers = init_fl_matchers(args.filter_list_dir, rules_cache_dir=args.rules_cache_dir)
+    decision_cache = BlockDecisionCache(args.decision_cache) if args.decision_cache else None
 
     # Now match each input json file against each filter list
+    nomoads_paths = []
     for valid_dir in args.nomoads_dirs:
         print("Processing: ", valid_dir)
-        for nomoads_file in glob.iglob(valid_dir + os.sep + "*-nomoads.json"):
+        for nomoads_file in sorted(nomoads_file for extension in nomoads_format.EXTENSIONS
+                                   for nomoads_file in glob.iglob(valid_dir + os.sep + "*-nomoads" + extension)):
             print("Found nomoads json ", nomoads_file)
             nomoads_path = nomoads_file
             if nomoads_file == ".DS_Store":
@@ -276,16 +600,11 @@ if __name__ == '__main__':
             if os.path.isdir(nomoads_path):
                 # Skip sub dirs.
                 continue
-            # Load json file into memory.
-            nomoads_json = read_nomoads_json(nomoads_path)
-            # Perform rule matching for all filter lists.
-            for fl_tup in fl_matchers:
-                nomoads_json = annotate_nomoads_json(fl_tup[1], nomoads_json, fl_tup[0])
-
-            # make the output directory
-            fl_result_dir = os.path.join(valid_dir, args.out_dir_name)
-            if not os.path.isdir(fl_result_dir):
-                os.makedirs(fl_result_dir)
-            #print("Writing to ", fl_result_dir)
-            # Json has now been annotated with blocking decisions for all filter lists. Write result to output dir.
-            write_annotated_nomoads_json(nomoads_json, fl_result_dir + os.sep + os.path.basename(nomoads_path))
+            nomoads_paths.append(nomoads_path)
+
+    annotate_nomoads_files(fl_matchers, nomoads_paths, args.out_dir_name, jobs=args.jobs,
+                           decision_cache=decision_cache)
+
+    if decision_cache is not None:
+        decision_cache.close()
+        print(decision_cache.get_stats())
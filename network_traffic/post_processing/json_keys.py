@@ -12,12 +12,16 @@
 #
 # See the LICENSE.md file along with OVRseen for more details.
 
+import os
+
 package_name = "package_name"
 version = "package_version"
 type = "type"
 ats_pkg = "ats_pkg"
 id = "pkt_id"
 pii_label = "pii_types"
+# Number of bytes of the body of a packet (or of the packets of a flow) that were scanned for PII
+pii_scan_bytes = "pii_scan_bytes"
 predicted = "predicted"
 list_label = "list_labels"
 
@@ -61,6 +65,11 @@ irc = "irc"
 websocket = "websocket"
 websocketdata = "data-text-lines"
 
+# Flow records: the packets of a TCP connection aggregated into one record
+flow_last_ts = "last_ts"
+flow_pkt_count = "pkt_count"
+flow_urls = "urls"
+
 # From Lab for VR
 LOCATION_PII = [{"33.6459","-117.843"}, {"33.65","-117.84"},  {"33.6","-117.8"}, {"33.7","-117.8"}]
 
@@ -280,10 +289,50 @@ OTHER__PII_VALUES__WEBSOCKET = {
 }
 
 
-# merge the above dict into one. Make sure the keys are unique
-PII_VALUES = dict()
-PII_VALUES.update(QUEST2A__PII_VALUES)
-PII_VALUES.update(QUEST2B__PII_VALUES)
-PII_VALUES.update(OTHER__PII_VALUES)
-PII_VALUES.update(OTHER__PII_VALUES__BY_KEY)
-PII_VALUES.update(OTHER__PII_VALUES__WEBSOCKET)
+# PII of each headset, by device profile. The traffic of a headset is scanned for its own PII and the shared OTHER__ PII
+DEVICE_PII_VALUES = {
+    "quest2a": QUEST2A__PII_VALUES,
+    "quest2b": QUEST2B__PII_VALUES,
+}
+# Device profile that scans for the PII of all headsets, e.g., to audit the traffic of one headset for the PII of another
+ALL_DEVICES = "all"
+DEVICE_PROFILES = list(DEVICE_PII_VALUES) + [ALL_DEVICES]
+
+
+def get_pii_values(device=ALL_DEVICES):
+    """
+    :param device: a device profile of DEVICE_PROFILES
+    :return: the PII to scan the traffic of the device for: its own PII (or that of all headsets for ALL_DEVICES),
+             and the shared OTHER__ PII
+    """
+    if device == ALL_DEVICES:
+        device_pii_values = list(DEVICE_PII_VALUES.values())
+    elif device in DEVICE_PII_VALUES:
+        device_pii_values = [DEVICE_PII_VALUES[device]]
+    else:
+        raise ValueError("Unknown device profile: %s (one of %s)" % (device, ", ".join(DEVICE_PROFILES)))
+
+    # merge the dicts into one. Make sure the keys are unique
+    pii_values = dict()
+    for values in device_pii_values:
+        pii_values.update(values)
+    pii_values.update(OTHER__PII_VALUES)
+    pii_values.update(OTHER__PII_VALUES__BY_KEY)
+    pii_values.update(OTHER__PII_VALUES__WEBSOCKET)
+    return pii_values
+
+
+def get_device_profile(capture_dir, default=ALL_DEVICES):
+    """
+    :param capture_dir: a directory of captures, e.g., the subdirectory of an app
+    :return: the device profile of the captures: the name of the closest directory of the path that is a device
+             profile (e.g., dataset/quest2a/<app>), or default if there is none
+    """
+    for dir_name in reversed(os.path.normpath(os.path.abspath(capture_dir)).split(os.sep)):
+        if dir_name.lower() in DEVICE_PROFILES:
+            return dir_name.lower()
+    return default
+
+
+# PII of all headsets
+PII_VALUES = get_pii_values(ALL_DEVICES)
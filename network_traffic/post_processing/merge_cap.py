@@ -3,26 +3,47 @@
 """
 Use this script to merge encrypted/decrypted PCAP files into one
 USAGE:
-$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY
+$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY [--projected] [--outgoing_only]
 """
 
 import os, sys
+import argparse
 
 from subprocess import call
 from subprocess import check_call
 
-
-def merge_in_dir(encdec, dir_path):
+import json_keys
+
+# Layers of the tshark JSON output that are read by extract_from_tshark.py. In projected mode, tshark only
+# dissects these into the JSON file (with all of their child nodes, so that the layer structure stays the same).
+PROJECTED_LAYERS = [json_keys.frame,
+                    json_keys.pkt_comment,
+                    json_keys.ip,
+                    json_keys.tcp,
+                    json_keys.http,
+                    json_keys.ssl,
+                    json_keys.websocket,
+                    json_keys.websocketdata,
+                    json_keys.irc]
+
+# Display filter for the packets that extract_from_tshark.py keeps: outgoing TCP traffic from the device that carries
+# one of the application layer protocols we are interested in. Everything else is dropped inside tshark.
+OUTGOING_TRAFFIC_FILTER = "%s.src == %s && %s && (%s)" % (json_keys.ip, json_keys.ANTMONITOR_SRC_IP, json_keys.tcp,
+                                                          " || ".join([json_keys.http, json_keys.ssl,
+                                                                       json_keys.websocket, json_keys.irc]))
+
+
+def merge_in_dir(encdec, dir_path, projected=False, display_filter=None):
+    """
+    Merges the encrypted or decrypted PCAP files in a directory and converts the merged file to tshark JSON.
+    The commands run inside dir_path, without changing the working directory of the caller.
+    :return: the path of the tshark JSON file, or None if dir_path is not a directory
+    """
     dir_path = os.path.abspath(dir_path)
 
     if not os.path.isdir(dir_path):
         print("ERROR: " + dir_path + " is not a directory!")
-        sys.exit(-1)
-
-    try:
-        os.chdir(dir_path)
-    except (WindowsError, OSError):
-        print("Could not change directory to " + dir_path)
+        return None
 
     files_to_merge = []
     for fn in os.listdir(dir_path):
@@ -40,7 +61,7 @@ def merge_in_dir(encdec, dir_path):
     cmd = ["mergecap", "-w", outFile]
     cmd += files_to_merge
 
-    call(cmd)
+    call(cmd, cwd=dir_path)
     print("Merged " + str(len(files_to_merge)) + " files into " + outFile)
 
     if encdec == '-enc':
@@ -53,17 +74,33 @@ def merge_in_dir(encdec, dir_path):
            "-o", "tcp.desegment_tcp_streams:TRUE",
            "-o", "http.desegment_body:TRUE",
            "-r", outFile, "-T", "json"]
+    if projected:
+        # Leave out the layers (eth, sll, etc.) that extract_from_tshark.py never looks at
+        cmd += ["-J", " ".join(PROJECTED_LAYERS)]
+    if display_filter:
+        cmd += ["-Y", display_filter]
 
-    with open(jsonFile, "wb") as jf:
-        check_call(cmd, stdout=jf)
+    with open(os.path.join(dir_path, jsonFile), "wb") as jf:
+        check_call(cmd, stdout=jf, cwd=dir_path)
 
     print("Saved " + jsonFile)
+    return os.path.join(dir_path, jsonFile)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3 or not (sys.argv[1] == '-dec' or sys.argv[1] == '-enc'):
-        print("ERROR: incorrect number of arguments or wrong arguments. Correct usage:")
-        print("\t$ python merge_cap.py [-dec | -enc] PATH_TO_PCAP_DIRECTORY")
-        sys.exit(1)
-
-    merge_in_dir(sys.argv[1], sys.argv[2])
+    ap = argparse.ArgumentParser(description="Merges encrypted/decrypted PCAP files into one and converts it to JSON")
+    encdec_group = ap.add_mutually_exclusive_group(required=True)
+    encdec_group.add_argument('-dec', dest='encdec', action='store_const', const='-dec',
+                              help='Merge the decrypted PCAP files')
+    encdec_group.add_argument('-enc', dest='encdec', action='store_const', const='-enc',
+                              help='Merge the encrypted PCAP files')
+    ap.add_argument('dir_path', help='Directory containing the PCAP files')
+    ap.add_argument('--projected', action="store_true",
+                    help='Only export the layers that extract_from_tshark.py reads')
+    ap.add_argument('--outgoing_only', action="store_true",
+                    help='Only export outgoing TCP packets that extract_from_tshark.py can use')
+    args = ap.parse_args()
+
+    if merge_in_dir(args.encdec, args.dir_path, projected=args.projected,
+                    display_filter=OUTGOING_TRAFFIC_FILTER if args.outgoing_only else None) is None:
+        sys.exit(-1)
@@ -0,0 +1,110 @@
+"""
+Reads and writes packets in NoMoAds format. The format of a file is given by its extension:
+- ".json": a single JSON object that maps each packet id to its packet (the original format).
+- ".jsonl": one JSON object per line, for each packet, with the packet id under the "pkt_id" key. Packets can be
+  appended one by one and read back one by one, without holding the whole file in memory.
+- ".jsonl.gz": the same as ".jsonl", compressed with gzip.
+Packets are read as PacketRecord, with string packet ids in all formats, and written from any mapping.
+"""
+
+import gzip
+import json
+
+from packet_record import PacketRecord
+
+JSON_EXTENSION = ".json"
+JSONL_EXTENSION = ".jsonl"
+JSONL_GZ_EXTENSION = ".jsonl.gz"
+# the longest extensions first, so that they are stripped entirely
+EXTENSIONS = [JSONL_GZ_EXTENSION, JSONL_EXTENSION, JSON_EXTENSION]
+
+json_key_pkt_id = "pkt_id"
+
+
+def get_extension(path):
+    """
+    :return: The NoMoAds extension of the path, or None if it has none.
+    """
+    for extension in EXTENSIONS:
+        if path.endswith(extension):
+            return extension
+    return None
+
+
+def strip_extension(path):
+    """
+    :return: The path without its NoMoAds extension.
+    """
+    extension = get_extension(path)
+    return path[:-len(extension)] if extension else path
+
+
+def is_line_delimited(path):
+    """
+    :return: True if the path is in the line-delimited format, False otherwise.
+    """
+    return get_extension(path) in (JSONL_EXTENSION, JSONL_GZ_EXTENSION)
+
+
+def _open(path, mode):
+    if path.endswith(JSONL_GZ_EXTENSION):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def iter_packets(path):
+    """
+    Reads the packets of a NoMoAds file. Packets of the line-delimited formats are read one at a time.
+    :param path: The path to the NoMoAds file.
+    :return: An iterator of (packet id, PacketRecord) tuples.
+    """
+    if not is_line_delimited(path):
+        with _open(path, "r") as f:
+            data = json.load(f)
+        # the dict of each packet is released once its record is created
+        for pkt_id in list(data):
+            yield pkt_id, PacketRecord(data.pop(pkt_id))
+        return
+
+    with _open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            pkt = json.loads(line)
+            yield str(pkt.pop(json_key_pkt_id)), PacketRecord(pkt)
+
+
+def read_packets(path):
+    """
+    :param path: The path to the NoMoAds file.
+    :return: The in-memory representation of the NoMoAds file: a dict of packets by packet id.
+    """
+    return dict(iter_packets(path))
+
+
+def to_json_object(packets):
+    """
+    :param packets: An iterable of (packet id, packet) tuples.
+    :return: The JSON object of the packets in the ".json" format.
+    """
+    return {pkt_id: dict(pkt) for pkt_id, pkt in packets}
+
+
+def write_packets(path, packets, mode="w"):
+    """
+    Writes packets to a NoMoAds file. Packets of the line-delimited formats are written one at a time.
+    :param path: The path to the NoMoAds file.
+    :param packets: An iterable of (packet id, packet) tuples.
+    :param mode: "w" to overwrite the file, "a" to append the packets to it (line-delimited formats only).
+    """
+    if not is_line_delimited(path):
+        with _open(path, mode) as f:
+            f.write(json.dumps(to_json_object(packets), sort_keys=True, indent=4))
+        return
+
+    with _open(path, mode) as f:
+        for pkt_id, pkt in packets:
+            line = dict(pkt)
+            line[json_key_pkt_id] = pkt_id
+            f.write(json.dumps(line, sort_keys=True, separators=(",", ":")))
+            f.write("\n")
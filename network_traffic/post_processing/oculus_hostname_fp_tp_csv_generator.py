@@ -1,6 +1,9 @@
 import unicodecsv as csv
 import argparse
-import tldextract
+import functools
+from collections import Counter
+
+import esld_resolver
 
 
 class DeviceAppInfo:
@@ -48,8 +51,10 @@ def _is_platform(app_info, hostname, consider_domain_only=False):
     return False
 
 
-def _get_second_level_domain_from_tld(url_tld):
-    return url_tld.domain + "." + url_tld.suffix
+@functools.lru_cache(maxsize=None)
+def _get_package_name_tokens(package_name):
+    package_name_tokens = package_name.split(".")
+    return tuple(x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2)
 
 
 def _is_first_party(sld, package_name, current_app, host_name):
@@ -60,10 +65,9 @@ def _is_first_party(sld, package_name, current_app, host_name):
         return True
 
     # tokenize package_name
-    package_name_tokens = package_name.split(".")
-    package_name_tokens = [x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2]
+    package_name_tokens = list(_get_package_name_tokens(package_name))
 
-    dest_domain_parsed = tldextract.extract(host_name)
+    dest_domain_parsed = esld_resolver.extract(host_name)
 
     # extract the eSLD for comparison
     # if it's hosted on a cloud service, take the subdomain instead
@@ -75,7 +79,7 @@ def _is_first_party(sld, package_name, current_app, host_name):
 
     # check privacy policy url first
     if current_app.policy_url and current_app.policy_url != "N/A":
-        policy_domain_parsed = tldextract.extract(current_app.policy_url)
+        policy_domain_parsed = esld_resolver.extract(current_app.policy_url)
         if policy_domain_parsed.registered_domain == domain_cmp:
             print("First party due to privacy url %s, package name %s, hostname %s" %
                   (current_app.policy_url, package_name, host_name))
@@ -102,7 +106,18 @@ def get_ais_key(app_id, package_name):
     return app_id+package_name
 
 
-def get_party_labels(sld, current_app, hostname):
+def get_sld_developers(hostname_to_apps):
+    """
+    :return: a dict mapping an SLD to the set of developer names of the apps contacting it
+    """
+    return {sld: {app.developer_name for app in apps} for sld, apps in hostname_to_apps.items()}
+
+
+def get_party_labels(sld, current_app, hostname, hostname_to_apps, sld_developers=None):
+    """
+    :param sld_developers: the developer names of the apps contacting each SLD, as returned by get_sld_developers,
+                           or None to compare the developer names of the apps in hostname_to_apps
+    """
     party_labels = []
 
     package = current_app.app_package
@@ -113,11 +128,14 @@ def get_party_labels(sld, current_app, hostname):
     apps_contacted = hostname_to_apps[sld]
     if apps_contacted and len(apps_contacted) > 1:
         # good chance it could be third party
-        same_developer = True
-        for other_app in apps_contacted:
-            if other_app.developer_name != current_app.developer_name:
-                same_developer = False
-                break
+        if sld_developers is not None:
+            same_developer = sld_developers[sld] == {current_app.developer_name}
+        else:
+            same_developer = True
+            for other_app in apps_contacted:
+                if other_app.developer_name != current_app.developer_name:
+                    same_developer = False
+                    break
 
         if not same_developer:
             if _is_first_party(sld, package, current_app, hostname):
@@ -190,14 +208,18 @@ FORCE_FIRST_PARTY["com.ivre.engage"] = ["d71b97dri9uky.cloudfront.net"]
 FORCE_FIRST_PARTY["com.StudioHORANG.SphereToonQuest"] = ["220.230.112.14"]
 
 
-if __name__ == '__main__':
-    ap = argparse.ArgumentParser(description="Given a csv of pkts/flows for Oculus, we label each one whether it is first party, thirdparty, unknown, potential platform")
-    ap.add_argument("in_csv", help="CSV where each row represents an app pkt/flow within " +
-                    platform_id_oculus + ".")
-    ap.add_argument("out_csv", help="Output CSV where to write results.")
+def _get_developer_name(row):
+    if row[csv_key_app_developer_oculus]:
+        return row[csv_key_app_developer_oculus]
+    return row[csv_key_app_developer_sidequest]
 
-    args = ap.parse_args()
 
+def get_app_infos(rows):
+    """
+    Creates the in-memory object representation of the rows (dicts of CSV column name to string value).
+    :return: a tuple (dict mapping an app ID to an AppInfo, dict mapping an SLD to a list of AppInfo,
+                      dict mapping a hostname to its SLD)
+    """
     # Dict mapping an app ID to an AppInfo
     ais = {}
 
@@ -206,99 +228,176 @@ if __name__ == '__main__':
 
     hostname_to_sld = {}
 
-    # Read data from CSV and create in-memory object representation of that data.
-    with open(args.in_csv, "rb") as in_csv_file:
-        csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
-        # row_num = 0
-        for row in csv_reader:
-            app_id = row[csv_key_app_id]
-            hostname = row[csv_key_hostname]
-            app_name = row[csv_key_app_name_from_web_store]
-            package_name = row[csv_key_package_name]
-            if row[csv_key_app_developer_oculus]:
-                developer_name = row[csv_key_app_developer_oculus]
-            else:
-                developer_name = row[csv_key_app_developer_sidequest]
-            app_package_name = row[csv_key_app_package]
-            second_level_domain = row[csv_key_sld_label]
-            policy_url = row[csv_key_policy_url]
-
-            # turn hostname into sld
-            if hostname not in hostname_to_sld:
-                hostname_to_sld[hostname] = second_level_domain
-
-            sld = second_level_domain
-            key = get_ais_key(app_id,package_name)
-
-            # Get existing AppInfo, if any, otherwise create new.
-            ai = ais.get(key, DeviceAppInfo(app_id, app_name, package_name,
-                                            developer_name, app_package_name, policy_url))
-            # Associate hostname with app.
-            ai.set_contacts_hostname(sld)
-
-            # Update dict (in case we ended up creating a new AppInfo above)
-            if key not in ais:
-                ais[key] = ai
-
-            # Update dict of hostname to DeviceAppInfo
-            if sld not in hostname_to_apps:
-                hostname_to_apps[sld] = []
-            if ai not in hostname_to_apps[sld]:
-                hostname_to_apps[sld].append(ai)
-                if len(hostname_to_apps[sld]) > 1:
-                    print("Found new app %s contacting sld %s, original hostname %s" % (ai.app_id, sld, hostname))
+    # row_num = 0
+    for row in rows:
+        app_id = row[csv_key_app_id]
+        hostname = row[csv_key_hostname]
+        app_name = row[csv_key_app_name_from_web_store]
+        package_name = row[csv_key_package_name]
+        developer_name = _get_developer_name(row)
+        app_package_name = row[csv_key_app_package]
+        second_level_domain = row[csv_key_sld_label]
+        policy_url = row[csv_key_policy_url]
+
+        # turn hostname into sld
+        if hostname not in hostname_to_sld:
+            hostname_to_sld[hostname] = second_level_domain
+
+        sld = second_level_domain
+        key = get_ais_key(app_id,package_name)
+
+        # Get existing AppInfo, if any, otherwise create new.
+        ai = ais.get(key, DeviceAppInfo(app_id, app_name, package_name,
+                                        developer_name, app_package_name, policy_url))
+        # Associate hostname with app.
+        ai.set_contacts_hostname(sld)
+
+        # Update dict (in case we ended up creating a new AppInfo above)
+        if key not in ais:
+            ais[key] = ai
+
+        # Update dict of hostname to DeviceAppInfo
+        if sld not in hostname_to_apps:
+            hostname_to_apps[sld] = []
+        if ai not in hostname_to_apps[sld]:
+            hostname_to_apps[sld].append(ai)
+            if len(hostname_to_apps[sld]) > 1:
+                print("Found new app %s contacting sld %s, original hostname %s" % (ai.app_id, sld, hostname))
 
     print("Found %d App Infos for Device" % len(ais))
+    return ais, hostname_to_apps, hostname_to_sld
+
+
+class PartyLabeler:
+    """
+    Labels the rows of apps pkts/flows. The labels only depend on the app and the hostname of a row, so they are
+    computed once for each distinct (app, hostname) pair, and the rows are counted for a summary instead of being
+    logged one by one.
+    """
+
+    def __init__(self, ais, hostname_to_apps, hostname_to_sld):
+        """
+        :param ais, hostname_to_apps, hostname_to_sld: the in-memory representation of the rows, as returned by
+                                                      get_app_infos
+        """
+        self.ais = ais
+        self.hostname_to_apps = hostname_to_apps
+        self.hostname_to_sld = hostname_to_sld
+        self.sld_developers = get_sld_developers(hostname_to_apps)
+        # (app key, hostname) -> party labels, as returned by get_row_party_labels
+        self.labels = {}
+        self.label_counts = Counter()
+        self.skipped_rows = 0
+
+    def get_row_party_labels(self, row):
+        """
+        :return: a tuple (party labels with third-party and unknown merged together, real party labels with unknown),
+                 or None if the row does not belong to a known app
+        """
+        hostname = row[csv_key_hostname]
+        key = get_ais_key(row[csv_key_app_id], row[csv_key_package_name])
+        party_labels = self.labels.get((key, hostname))
+        if party_labels is None:
+            party_labels = self._get_party_labels(key, hostname, row)
+            self.labels[(key, hostname)] = party_labels
+
+        if party_labels is None:
+            self.skipped_rows += 1
+        else:
+            self.label_counts[party_labels[1]] += 1
+        return party_labels
+
+    def _get_party_labels(self, key, hostname, row):
+        ai = self.ais.get(key)
+        if not ai:
+            print("ERROR: could not find App info for %s, %s" % (row[csv_key_app_id],
+                                                                 row[csv_key_app_name_from_web_store]))
+            print("Skipping rows of hostname " + hostname)
+            return None
+
+        sld = self.hostname_to_sld[hostname]
+        party_labels = get_party_labels(sld, ai, hostname, self.hostname_to_apps, self.sld_developers)
+
+        # add party label
+        party_labels_merge_third_and_unknown = []
+        for label in party_labels:
+            if label == UNKNOWN_PARTY:
+                party_labels_merge_third_and_unknown.append(THIRD_PARTY)
+            else:
+                party_labels_merge_third_and_unknown.append(label)
+
+        return ";".join(party_labels_merge_third_and_unknown), ";".join(party_labels)
+
+    def get_summary(self):
+        """
+        :return: a summary of the labeled rows
+        """
+        rows = sum(self.label_counts.values())
+        summary = ["Labeled %d rows (%d distinct app and hostname pairs), skipped %d rows" %
+                   (rows, len(self.labels), self.skipped_rows)]
+        for party_labels, count in self.label_counts.most_common():
+            summary.append("  %s: %d rows" % (party_labels, count))
+        return "\n".join(summary)
+
+
+def add_party_labels(df):
+    """
+    Adds the party label columns to a DataFrame of app pkts/flows. Rows that do not belong to a known app are dropped,
+    like in the CSV output.
+    """
+    keys = [csv_key_app_id, csv_key_hostname, csv_key_app_name_from_web_store, csv_key_package_name,
+            csv_key_app_developer_oculus, csv_key_app_developer_sidequest, csv_key_app_package, csv_key_sld_label,
+            csv_key_policy_url]
+    # Missing values are empty strings in the CSV files
+    rows = df[keys].fillna("").astype(str).to_dict("records")
+    labeler = PartyLabeler(*get_app_infos(rows))
+    labels = [labeler.get_row_party_labels(row) for row in rows]
+    print(labeler.get_summary())
+
+    labeled = [label is not None for label in labels]
+    df = df[labeled].copy()
+    df[csv_key_party_label] = [label[0] for label in labels if label is not None]
+    df[csv_key_real_party_label] = [label[1] for label in labels if label is not None]
+    return df
+
+
+def label_csv(in_csv, out_csv):
+    # Read data from CSV and create in-memory object representation of that data.
+    with open(in_csv, "rb") as in_csv_file:
+        csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
+        labeler = PartyLabeler(*get_app_infos(csv_reader))
 
     # read in the file again to do the second time to label each row, and write it out as well
-    with open(args.in_csv, "rb") as in_csv_file:
+    with open(in_csv, "rb") as in_csv_file:
         csv_reader = csv.DictReader(in_csv_file, delimiter=",", quotechar='"')
 
-        with open(args.out_csv, "wb") as out_csv_file:
+        with open(out_csv, "wb") as out_csv_file:
             csv_writer = csv.writer(out_csv_file, encoding="utf-8")
             csv_header = csv_reader.fieldnames + [csv_key_party_label, csv_key_real_party_label]
             csv_writer.writerow(csv_header)
 
             # row_num = 0
             for row in csv_reader:
-                app_id = row[csv_key_app_id]
-                hostname = row[csv_key_hostname]
-                app_name = row[csv_key_app_name_from_web_store]
-                package_name = row[csv_key_package_name]
-                if row[csv_key_app_developer_oculus]:
-                    developer_name = row[csv_key_app_developer_oculus]
-                else:
-                    developer_name = row[csv_key_app_developer_sidequest]
-                # Get existing AppInfo, if any, otherwise create new.
-                key = get_ais_key(app_id, package_name)
-                ai = ais.get(key)
-                if not ai:
-                    print("ERROR: could not find App info for %s, %s" + (app_id, app_name))
-                    print("Skipping row " + hostname)
+                party_labels = labeler.get_row_party_labels(row)
+                if party_labels is None:
                     continue
 
-                sld = hostname_to_sld[hostname]
-                print("*******Getting party label for App %s, Developer %s, sld: %s, hostname: %s" % (ai.app_name, developer_name, sld, hostname))
-
-                party_labels = get_party_labels(sld, ai, hostname)
-                print("Party labels %s found for SLD %s" % (",".join(party_labels), sld))
-                print("*******Done party label for App %s, Developer %s, sld: %s, hostname: %s" % (ai.app_name, developer_name, sld, hostname))
-
                 # put into array by header order (ignoring the last column, since that is party_labels)
                 data_row = [row[header_name] for header_name in csv_header[0:-2]]
+                data_row.extend(party_labels)
 
-                # add party label
-                party_labels_merge_third_and_unknown = []
-                for label in party_labels:
-                    if label == UNKNOWN_PARTY:
-                        party_labels_merge_third_and_unknown.append(THIRD_PARTY)
-                    else:
-                        party_labels_merge_third_and_unknown.append(label)
+                # write row
+                csv_writer.writerow(data_row)
 
-                data_row.append(";".join(party_labels_merge_third_and_unknown))
+    print(labeler.get_summary())
 
-                # real party labels have unknowns
-                data_row.append(";".join(party_labels))
 
-                # write row
-                csv_writer.writerow(data_row)
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="Given a csv of pkts/flows for Oculus, we label each one whether it is first party, thirdparty, unknown, potential platform")
+    ap.add_argument("in_csv", help="CSV where each row represents an app pkt/flow within " +
+                    platform_id_oculus + ".")
+    ap.add_argument("out_csv", help="Output CSV where to write results.")
+
+    args = ap.parse_args()
+
+    label_csv(args.in_csv, args.out_csv)
@@ -0,0 +1,126 @@
+"""
+Compact in-memory representation of a packet (or flow record) in NoMoAds format.
+A PacketRecord behaves like the dict of the packet in the NoMoAds json: the fields extracted from tshark are stored in
+slots instead of a dict per packet, the other fields (e.g., the block decision of each filter list) in a dict that is
+only created when one is set, and the strings that repeat across packets (hostnames, package names, IPs, header names)
+are interned. Packets are converted to dicts only when they are written to a NoMoAds file.
+"""
+
+import sys
+from collections.abc import MutableMapping
+
+import json_keys
+
+# Keys of the packet fields stored in slots, and their slot names
+FIELD_SLOTS = {json_keys.protocol: "protocol",
+               json_keys.host: "host",
+               json_keys.method: "method",
+               json_keys.uri: "uri",
+               json_keys.headers: "headers",
+               json_keys.http_body: "http_body",
+               json_keys.pii_label: "pii_types",
+               json_keys.pii_scan_bytes: "pii_scan_bytes",
+               json_keys.src_ip: "src_ip",
+               json_keys.dst_ip: "dst_ip",
+               json_keys.dst_port: "dst_port",
+               json_keys.tcpstream: "tcp_stream",
+               json_keys.package_name: "package_name",
+               json_keys.version: "package_version",
+               "ts": "ts",
+               json_keys.flow_last_ts: "last_ts",
+               json_keys.flow_pkt_count: "pkt_count",
+               json_keys.flow_urls: "urls"}
+
+# Keys of the string fields that are interned
+INTERNED_KEYS = {json_keys.protocol, json_keys.host, json_keys.method, json_keys.src_ip, json_keys.dst_ip,
+                 json_keys.package_name, json_keys.version}
+
+
+class PacketRecord(MutableMapping):
+    """
+    A packet in NoMoAds format. A field is missing until it is set, like a key of a dict.
+    """
+
+    __slots__ = tuple(FIELD_SLOTS.values()) + ("extra",)
+
+    def __init__(self, fields=None):
+        """
+        :param fields: The fields of the packet, e.g., the dict of the packet in the NoMoAds json.
+        """
+        self.extra = None
+        if fields:
+            for key, value in fields.items():
+                if key == json_keys.headers and isinstance(value, dict):
+                    value = {sys.intern(header_key): header_value for header_key, header_value in value.items()}
+                self[key] = value
+
+    def __getitem__(self, key):
+        slot = FIELD_SLOTS.get(key)
+        if slot is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        slot = FIELD_SLOTS.get(key)
+        if slot is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            return
+        if key in INTERNED_KEYS and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(self, slot, value)
+
+    def __delitem__(self, key):
+        slot = FIELD_SLOTS.get(key)
+        if slot is None:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            return
+        try:
+            delattr(self, slot)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        slot = FIELD_SLOTS.get(key)
+        if slot is None:
+            return self.extra is not None and key in self.extra
+        return hasattr(self, slot)
+
+    def get(self, key, default=None):
+        slot = FIELD_SLOTS.get(key)
+        if slot is None:
+            return default if self.extra is None else self.extra.get(key, default)
+        return getattr(self, slot, default)
+
+    def __iter__(self):
+        for key, slot in FIELD_SLOTS.items():
+            if hasattr(self, slot):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "PacketRecord(%r)" % dict(self)
+
+    def copy(self):
+        """
+        :return: A shallow copy of the packet.
+        """
+        record = PacketRecord()
+        for slot in FIELD_SLOTS.values():
+            if hasattr(self, slot):
+                setattr(record, slot, getattr(self, slot))
+        if self.extra:
+            record.extra = dict(self.extra)
+        return record
@@ -12,7 +12,7 @@
 #
 # See the LICENSE.md file along with OVRseen for more details.
 
-import hashlib, copy, re
+import hashlib, re
 import json_keys
 from urllib.parse import unquote
 
@@ -26,8 +26,30 @@ class PIIHelper(object):
     REDACT_PREFIX = "REDACTED_"
     REDACT_LOCATION = REDACT_PREFIX + PII_KEY_LOCATION.upper()
 
-
-    def __init__(self, pii_dict, location_coords, should_redact=False):
+    URL_ENCODED_PATTERN = re.compile(r'%[0-9a-f]')
+    # characters that make a PII value a regular expression rather than a plain string
+    REGEX_SPECIAL_CHARS = frozenset(".^$*+?{}[]\\|()")
+    # maximum number of header keys whose PII scan results are kept
+    HEADER_KEY_CACHE_SIZE = 10000
+
+    # In the bounded body scan mode, only the first max_body_scan_bytes bytes (UTF-8) of a body are kept and scanned,
+    # and the rest is replaced by REDACT_TRUNCATED. MAX_BODY_SCAN_BYTES is the suggested limit.
+    MAX_BODY_SCAN_BYTES = 1024 * 1024
+    REDACT_TRUNCATED = REDACT_PREFIX + "TRUNCATED_%d_BYTES"
+    # With skip_binary_bodies, bodies are split in chunks of this many characters. A chunk is binary (e.g., compressed
+    # or an image) if the start of it has a NUL character, more than BINARY_MAX_CONTROL_RATIO of control or undecodable
+    # characters, or looks like the hex bytes that tshark shows for non-text data. Binary chunks are not scanned, and
+    # are replaced by REDACT_BINARY so that no PII in them is kept.
+    BODY_CHUNK_SIZE = 64 * 1024
+    REDACT_BINARY = REDACT_PREFIX + "BINARY_DATA"
+    BINARY_SAMPLE_SIZE = 512
+    BINARY_MAX_CONTROL_RATIO = 0.1
+    CONTROL_CHAR_PATTERN = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffd]')
+    HEX_BYTES_PATTERN = re.compile(r'(?:[0-9a-f]{2}:){16}', re.I)
+
+
+    def __init__(self, pii_dict, location_coords, should_redact=False, max_body_scan_bytes=None,
+                 skip_binary_bodies=False):
         """
         :param pii_dict: dictionary containing pii type and its value.
             Both type and value must be of type string. Example:
@@ -37,11 +59,21 @@ class PIIHelper(object):
             }
         :param location_coords: a list of tuples of (latitude, longitude) coordinates. Example:
             [("33.64", "-117.84"), ("33.6", "-117.8")]
+        :param max_body_scan_bytes: the number of bytes of a body that are kept and scanned by get_pii_from_body, or
+            None to scan whole bodies
+        :param skip_binary_bodies: whether get_pii_from_body replaces the binary chunks of a body by REDACT_BINARY
+            instead of scanning them
         """
         self.pii_redact_values = {}
         self.pii_dict = {}
         self.location_coords = location_coords
         self.should_redact = should_redact
+        self.max_body_scan_bytes = max_body_scan_bytes
+        self.skip_binary_bodies = skip_binary_bodies
+        # header key -> PII types found in it
+        self.header_key_cache = {}
+        # bodies scanned, bytes scanned, binary chunks skipped, and bodies truncated by get_pii_from_body
+        self.body_scan_stats = {"bodies": 0, "scanned": 0, "binary_chunks": 0, "truncated": 0}
 
         for pii_key in pii_dict:
             # Add md5 and sha1 hashes to values to search for
@@ -55,6 +87,26 @@ class PIIHelper(object):
             self.pii_redact_values[pii_key] = PIIHelper.REDACT_PREFIX + \
                                               pii_key.upper().replace(" ", "_")
 
+        # redact from longer to shorter PII values
+        self.pii_keys_by_length = [pii_key for pii_key, _ in
+                                   sorted(self.pii_dict.items(), key=lambda t: -len(t[1][0]))]
+        self.pii_key_rank = {pii_key: rank for rank, pii_key in enumerate(self.pii_keys_by_length)}
+
+        # Compile each PII value (and its hashes) once, in the order in which they are searched for. A value that is a
+        # plain ASCII string is also kept lowercased, to skip the regex search on ASCII strings that do not contain it.
+        self.pii_patterns = [(pii_key, [(re.compile(pii_value, re.I), self._get_plain_value(pii_value))
+                                        for pii_value in self.pii_dict[pii_key]])
+                             for pii_key in self.pii_keys_by_length]
+
+
+    def _get_plain_value(self, pii_value):
+        """
+        :return: the lowercased PII value if it is a plain ASCII string (not a regular expression), None otherwise
+        """
+        if not pii_value.isascii() or any(c in PIIHelper.REGEX_SPECIAL_CHARS for c in pii_value):
+            return None
+        return pii_value.lower()
+
 
     def _is_numeric(self, value):
         return isinstance(value, int) or isinstance(value, float)
@@ -109,6 +161,69 @@ class PIIHelper(object):
         return updated_value, pii_found
 
 
+    def _find_all_pii(self, value, override_redacting=False):
+        """
+        Finds (and redacts) all regular pii inside "value", like _contains_pii for each pii key from longer to shorter
+        PII values. This is not a single pass over the string: each PII value (and hash) has its own precompiled
+        pattern, and they are searched one after another. A combined alternation of all of them was slower with re,
+        and its leftmost matches missed nested or overlapping PII values. On an ASCII string, the search for a plain
+        PII value is skipped when the lowercased string does not contain it, which is the same as a case-insensitive
+        search.
+        :param value: string that we search for pii
+        :return: a tuple - (the provided value with any PII redacted,
+                            the list of found PII types, from longer to shorter PII values)
+        """
+        should_redact = self.should_redact and not override_redacting
+        pii_keys_found = []
+        updated_value = value
+        lowered_value = value.lower() if value.isascii() else None
+
+        for pii_key, patterns in self.pii_patterns:
+            pii_found = False
+            for pattern, plain_value in patterns:
+                if plain_value is not None and lowered_value is not None and plain_value not in lowered_value:
+                    continue
+                if pattern.search(updated_value):
+                    pii_found = True
+                    if should_redact:
+                        updated_value = pattern.sub(self.pii_redact_values[pii_key], updated_value)
+                        lowered_value = updated_value.lower() if updated_value.isascii() else None
+            if pii_found:
+                pii_keys_found.append(pii_key)
+
+        return updated_value, pii_keys_found
+
+
+    def _is_binary_chunk(self, sample):
+        """
+        :param sample: the first BINARY_SAMPLE_SIZE characters of a chunk
+        :return: True if the chunk looks like binary data, False if it looks like text
+        """
+        if "\x00" in sample or PIIHelper.HEX_BYTES_PATTERN.match(sample):
+            return True
+        control_chars = len(PIIHelper.CONTROL_CHAR_PATTERN.findall(sample))
+        return control_chars > PIIHelper.BINARY_MAX_CONTROL_RATIO * len(sample)
+
+
+    def _split_body(self, value):
+        """
+        Splits "value" into chunks of BODY_CHUNK_SIZE characters, and merges the consecutive chunks that are all text or
+        all binary, so that a PII value is never split between two text chunks.
+        :return: a list of tuples - (part of the value, whether it is binary, the number of chunks in it)
+        """
+        # [start, end, whether it is binary, number of chunks] of each part
+        parts = []
+        for start in range(0, len(value), PIIHelper.BODY_CHUNK_SIZE):
+            end = min(start + PIIHelper.BODY_CHUNK_SIZE, len(value))
+            is_binary = self._is_binary_chunk(value[start:min(start + PIIHelper.BINARY_SAMPLE_SIZE, end)])
+            if parts and parts[-1][2] == is_binary:
+                parts[-1][1] = end
+                parts[-1][3] += 1
+            else:
+                parts.append([start, end, is_binary, 1])
+        return [(value[start:end], is_binary, chunks) for start, end, is_binary, chunks in parts]
+
+
     def _contains_location_pii_type(self, value):
         """
         Finds and redacts location coordinates that may be inside "value".
@@ -149,7 +264,7 @@ class PIIHelper(object):
         #    new_value = value.encode("utf-8")
 
         # may need to decode
-        if url_decoding and re.search(r'%[0-9a-f]', new_value):
+        if url_decoding and PIIHelper.URL_ENCODED_PATTERN.search(new_value):
             try:
                 #print("trying to decode string %s", new_value)
                 new_value = unquote(new_value)
@@ -158,14 +273,19 @@ class PIIHelper(object):
                 print(str(e))
                 pass
 
-        pii_keys_found = []
-        updated_value = new_value
-        # redact from longer to shorter PII values
-        for pii_key, _ in sorted(self.pii_dict.items(), key=lambda t: -len(t[1][0])):
+        if isinstance(new_value, str):
             # find regular pii
-            updated_value, pii_found = self._contains_pii(updated_value, pii_key, override_redacting=override_redacting)
-            if pii_found:
-                pii_keys_found.append(pii_key)
+            updated_value, pii_keys_found = self._find_all_pii(new_value, override_redacting=override_redacting)
+        else:
+            pii_keys_found = []
+            updated_value = new_value
+            # redact from longer to shorter PII values
+            for pii_key in self.pii_keys_by_length:
+                # find regular pii
+                updated_value, pii_found = self._contains_pii(updated_value, pii_key,
+                                                              override_redacting=override_redacting)
+                if pii_found:
+                    pii_keys_found.append(pii_key)
 
         updated_value, location_found = self._contains_location_pii_type(updated_value)
         if location_found:
@@ -174,13 +294,112 @@ class PIIHelper(object):
         return updated_value, pii_keys_found
 
 
-    def get_pii_from_data(self, json_data):
+    def get_pii_from_body(self, value, override_redacting=False):
+        """
+        Finds PII in an HTTP, websocket, or irc body (must be of string type) like get_pii_from_str. In the bounded body
+        scan mode, only the first max_body_scan_bytes bytes of the body are kept (if max_body_scan_bytes is set), and
+        binary chunks of it are replaced by REDACT_BINARY instead of being scanned (if skip_binary_bodies is set).
+        The text is not scanned in fixed-size windows that overlap: consecutive text chunks are merged, and each run of
+        them is scanned whole. Some PII values are regular expressions without a maximum length, so no overlap would
+        be enough to never split one of them, while a whole run finds and redacts the same PII as get_pii_from_str.
+        :return: a tuple - (the kept part of the body with any PII redacted, the list of found PII types,
+                            the number of bytes scanned)
+        """
+        if value is None:
+            return value, [], 0
+
+        self.body_scan_stats["bodies"] += 1
+        if self.max_body_scan_bytes is None and not self.skip_binary_bodies:
+            updated_value, pii_keys_found = self.get_pii_from_str(value, override_redacting=override_redacting)
+            scanned_bytes = len(value.encode("utf-8", "surrogatepass"))
+            self.body_scan_stats["scanned"] += scanned_bytes
+            return updated_value, pii_keys_found, scanned_bytes
+
+        truncated_bytes = 0
+        # a character is at most 4 bytes in UTF-8, so shorter bodies are never truncated
+        if self.max_body_scan_bytes is not None and len(value) * 4 > self.max_body_scan_bytes:
+            encoded_value = value.encode("utf-8", "surrogatepass")
+            if len(encoded_value) > self.max_body_scan_bytes:
+                # never keep the part of the body that is not scanned, since its PII would not be redacted
+                self.body_scan_stats["truncated"] += 1
+                truncated_bytes = len(encoded_value) - self.max_body_scan_bytes
+                value = encoded_value[:self.max_body_scan_bytes].decode("utf-8", "ignore")
+
+        # may need to decode
+        if PIIHelper.URL_ENCODED_PATTERN.search(value):
+            try:
+                value = unquote(value)
+            except Exception as e:
+                print(str(e))
+
+        updated_parts = []
+        pii_keys_found = set()
+        scanned_bytes = 0
+        parts = self._split_body(value) if self.skip_binary_bodies else [(value, False, 1)]
+        for part, is_binary, chunks in parts:
+            if is_binary:
+                self.body_scan_stats["binary_chunks"] += chunks
+                updated_parts.append(PIIHelper.REDACT_BINARY)
+                continue
+            scanned_bytes += len(part.encode("utf-8", "surrogatepass"))
+            updated_part, part_pii_keys_found = self._find_all_pii(part, override_redacting=override_redacting)
+            updated_parts.append(updated_part)
+            pii_keys_found.update(part_pii_keys_found)
+        if truncated_bytes:
+            updated_parts.append(PIIHelper.REDACT_TRUNCATED % truncated_bytes)
+        self.body_scan_stats["scanned"] += scanned_bytes
+
+        updated_value = "".join(updated_parts)
+        pii_keys_found = sorted(pii_keys_found, key=self.pii_key_rank.get)
+        updated_value, location_found = self._contains_location_pii_type(updated_value)
+        if location_found:
+            pii_keys_found.append(PIIHelper.PII_KEY_LOCATION)
+
+        return updated_value, pii_keys_found, scanned_bytes
+
+
+    def get_body_scan_stats(self, reset=False):
+        """
+        :param reset: Whether to reset the counters.
+        :return: A summary of the bodies scanned by get_pii_from_body.
+        """
+        stats = "Body PII scan: %d bodies, %d bytes scanned, %d binary chunks skipped, %d bodies truncated" % \
+                (self.body_scan_stats["bodies"], self.body_scan_stats["scanned"],
+                 self.body_scan_stats["binary_chunks"], self.body_scan_stats["truncated"])
+        if reset:
+            for key in self.body_scan_stats:
+                self.body_scan_stats[key] = 0
+        return stats
+
+
+    def _get_pii_from_header_key(self, header_key):
+        """
+        Finds PII in a header key, never redacting it. Header keys repeat across packets, so results are cached.
+        :return: the list of found PII types
+        """
+        pii_keys_found = self.header_key_cache.get(header_key)
+        if pii_keys_found is None:
+            if len(self.header_key_cache) >= PIIHelper.HEADER_KEY_CACHE_SIZE:
+                self.header_key_cache.clear()
+            _, pii_keys_found = self.get_pii_from_str(header_key, override_redacting=True)
+            self.header_key_cache[header_key] = pii_keys_found
+        return pii_keys_found
+
+
+    def get_pii_from_data(self, json_data, in_place=False):
         """
         Finds PII in the provided JSON data (NoMoAds format expected).
         Currently this method searches for PII in the URI and all HTTP header values
+        :param in_place: redact json_data itself instead of a copy of it (the caller does not need the original data)
         :return: a tuple - (the provided data with any PII redacted, the list of found PII types)
         """
-        redacted_data = copy.deepcopy(json_data) #  make sure we don't modify the original data
+        if in_place:
+            redacted_data = json_data
+        else:
+            #  make sure we don't modify the original data: only the top level and headers are updated
+            redacted_data = dict(json_data)
+        redacted_headers = {}
+
         redacted_uri = ""
         pii_keys_found = []
         if json_keys.uri in json_data:
@@ -190,15 +409,15 @@ class PIIHelper(object):
 
         redacted_data[json_keys.uri] = redacted_uri
 
-        for header_key in json_data[json_keys.headers]:
+        for header_key, header_value in json_data[json_keys.headers].items():
             # look for PII by header_key, never redact
-            _, header_key_pii_keys_found = self.get_pii_from_str(header_key, override_redacting=True)
-            pii_keys_found += header_key_pii_keys_found
+            pii_keys_found += self._get_pii_from_header_key(header_key)
 
             # look for PII in header values
-            redacted_header, header_pii_keys_found = self.get_pii_from_str(
-                                                        json_data[json_keys.headers][header_key])
-            redacted_data[json_keys.headers][header_key] = redacted_header
+            redacted_header, header_pii_keys_found = self.get_pii_from_str(header_value)
+            redacted_headers[header_key] = redacted_header
             pii_keys_found += header_pii_keys_found
 
+        redacted_data[json_keys.headers] = redacted_headers
+
         return redacted_data, list(set(pii_keys_found))
@@ -8,169 +8,511 @@ Basically, the scripts perform:
 3) Produce a unified JSON file in NoMoAds-style.
 4) Run the unified JSON file through the filter-list matching script.
 5) Finally, produce a CSV file that contains the flow of traffic for further processing (e.g., ATS analyses, policy analyses, etc.)
+
+The stages run in the same Python process (only mergecap and tshark are external commands): each packet flows from
+the extraction through the filter-list matching into its CSV row, and the filter lists are parsed only once. The NoMoAds
+JSON files of steps 3 and 4 are only written on request (write_intermediates), for debugging.
 '''
 
 import argparse
 import os
-import subprocess
+import sys
 import shutil
+import multiprocessing
+import numpy as np
 import pandas as pd
 
-from network_traffic.post_processing.utils.utils import DIR_DELIMITER
-from pandasql import sqldf
-
-pysqldf = lambda q: sqldf(q, globals())
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
 
 from gui import globals as gui_globals
 
+# The stages of the pipeline import each other as top-level modules, like when they are run as scripts (then their
+# directory is already on the path). When this module is imported from elsewhere (e.g., by the GUI), the directory is
+# appended to the path, so that the modules of the importing process are not shadowed by the stages.
+POST_PROCESSING_DIR = os.path.dirname(os.path.abspath(__file__))
+if POST_PROCESSING_DIR not in sys.path:
+    sys.path.append(POST_PROCESSING_DIR)
+
+import merge_cap
+import extract_from_tshark
+import json_keys
+import filter_list_checker_mult_dirs
+import block_decision_cache
+import block_decision_store
+import app_manifest
+import traffic_store
+import compare_results
+import esld_resolver
+import append_sld_to_csv
+import oculus_hostname_fp_tp_csv_generator
+
 # Filter list result directory
 FL_RESULT_DIR = "filters_matching_results"
+FILTER_LIST_DIR = os.path.join(POST_PROCESSING_DIR, "filter_lists")
+# Block decisions are kept across runs in this file
+BLOCK_DECISION_CACHE_FILE = os.path.join(POST_PROCESSING_DIR, "cache", "block_decisions.sqlite")
+# Parsed filter lists are kept across runs in this directory
+RULES_CACHE_DIR = os.path.join(POST_PROCESSING_DIR, "cache", "filter_lists")
+# Resolved eSLDs are kept across runs in this file
+ESLD_CACHE_FILE = esld_resolver.DEFAULT_CACHE_FILE
+
+TEMP_OUTPUT_NAME = "temp_output"
+CSV_TMP_NAME = "csv"
+# Directory of the Parquet traffic store, in the temporary output directory
+TRAFFIC_STORE_NAME = "traffic_store"
+
+# Filter list matchers, initialized once before the worker processes are forked so that all of them share it
+fl_matchers = []
+
 
-def run(dataset_root_dir: str, app_store_csvs_dir: str):
+def init_fl_matchers():
     """
-    dataset_root_dir: root directory of dataset
-    app_store_csvs_dir: directory of csvs about app stores
+    Parses the filter lists, unless it has already been done in this process.
+    returns the filter list matchers, as returned by filter_list_checker_mult_dirs.init_fl_matchers
+    """
+    if not fl_matchers:
+        fl_matchers.extend(filter_list_checker_mult_dirs.init_fl_matchers(FILTER_LIST_DIR,
+                                                                          rules_cache_dir=RULES_CACHE_DIR))
+    return fl_matchers
+
+
+# Persistent block decision cache (or None), set before the worker processes are forked
+decision_cache = None
+# Whether the NoMoAds JSON files of each app are written (for debugging), set before the worker processes are forked
+write_intermediate_files = False
+# Whether apps that did not change since the last run reuse their rows, set before the worker processes are forked
+incremental_runs = True
+# Whether the packets of each TCP connection are aggregated into one flow record, set before the worker processes
+# are forked
+flow_aggregation = False
+# Device profile whose PII the traffic of all apps is scanned for (json_keys.ALL_DEVICES to audit for the PII of all
+# headsets), or None to detect it from the directory of each app, set before the worker processes are forked
+device_profile = None
+# Options of the pipeline that change the rows of an app, recorded in its manifest
+APP_OPTIONS = {"include_http_body": True}
+
+
+def get_device_profile(apk_dir_path: str) -> str:
     """
+    returns the device profile whose PII the traffic of the app is scanned for
+    """
+    return device_profile or json_keys.get_device_profile(apk_dir_path)
 
-    dataset_root_abs_dir = os.path.abspath(dataset_root_dir)
-    app_store_csvs_abs_dir = os.path.abspath(app_store_csvs_dir)
 
-    TEMP_OUTPUT_NAME = "temp_output"
-    CSV_TMP_NAME = "csv"
-    output_tmp_dir = dataset_root_abs_dir + os.sep + TEMP_OUTPUT_NAME
-    if os.path.isdir(output_tmp_dir):
-        shutil.rmtree(output_tmp_dir)
-    os.makedirs(output_tmp_dir)
+def get_app_options(device: str) -> Dict:
+    """
+    device: the device profile of the app
+    returns the options of the pipeline that change the rows of an app
+    """
+    options = dict(APP_OPTIONS)
+    options["device"] = device
+    if flow_aggregation:
+        options["aggregate_flows"] = True
+    for option, value in extract_from_tshark.body_scan_options.items():
+        if value:
+            options[option] = value
+    return options
 
-    # keep track of dfs per store
-    data_frames = []
 
-    # For each app store:
-    #   Iterate over APK subdirectories that contain the PCAP files and call the necessary scripts
-    apk_dir_path_tuple = []
-    app_store_name = "ALL"
-    app_store_dir = os.path.join(dataset_root_abs_dir, app_store_name)
+def get_csv_header(fl_names: List[str]) -> List[str]:
+    """
+    returns the columns of the CSV rows of the apps
+    """
+    return compare_results.get_csv_header(fl_names, include_http_body=True, include_flow_fields=flow_aggregation)
+
+
+def init_decision_cache(cache_file: str):
+    """
+    cache_file: SQLite file of the block decision cache, or None to not keep the block decisions across runs
+    returns the block decision cache, or None
+    """
+    global decision_cache
+    if cache_file is None:
+        decision_cache = None
+    elif decision_cache is None or decision_cache.cache_file != cache_file:
+        decision_cache = block_decision_cache.BlockDecisionCache(cache_file)
+    return decision_cache
+
 
-    for apk_dir in os.listdir(dataset_root_abs_dir):
-        if apk_dir == ".DS_Store" or apk_dir == TEMP_OUTPUT_NAME or apk_dir == CSV_TMP_NAME:
+def list_apk_dirs(parent_dir: str, skipped_dirs: List[str]) -> List[Tuple[str, str]]:
+    """
+    parent_dir: directory that contains one subdirectory of PCAP files per app
+    skipped_dirs: names of subdirectories that do not belong to an app
+    returns the (absolute path, name) of each app subdirectory, sorted by name so that outputs are deterministic
+    """
+    apk_dir_path_tuple = []
+    for apk_dir in sorted(os.listdir(parent_dir)):
+        if apk_dir == ".DS_Store" or apk_dir == '__MACOSX' or apk_dir in skipped_dirs:
             continue
         # Get the absolute path
-        apk_dir_path = os.path.join(dataset_root_abs_dir, apk_dir)
-        if apk_dir == '__MACOSX' or not os.path.isdir(apk_dir_path):
+        apk_dir_path = os.path.join(parent_dir, apk_dir)
+        if not os.path.isdir(apk_dir_path):
             continue
-        gui_globals.redirect_print_func(f"Processing data from App apk: {app_store_name}")
+        apk_dir_path_tuple.append((apk_dir_path, apk_dir))
+    return apk_dir_path_tuple
+
 
+def map_apps(func, apk_dir_path_tuple: List[Tuple[str, str]], jobs: int) -> Iterator:
+    """
+    func: module-level function called with the (absolute path, name) of each app subdirectory
+    jobs: number of apps processed concurrently
+    yields the results of func in the order of apk_dir_path_tuple, each one as soon as it and those before it are done
+    """
+    if jobs <= 1 or len(apk_dir_path_tuple) <= 1:
+        for apk_dir_path, apk_dir in apk_dir_path_tuple:
+            yield func(apk_dir_path, apk_dir)
+        return
+    # The workers are forked, so they get the filter list matchers of this process without parsing them again
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+        yield from executor.map(func, *zip(*apk_dir_path_tuple))
 
 
-        gui_globals.redirect_print_func(f"[.] {app_store_name}: Begin the pipeline for app " + apk_dir + "...\n")
+def merge_app_pcaps(apk_dir_path: str):
+    """
+    Steps 1-2 of the pipeline for one app: merge the PCAP files and produce the tshark JSON files. The decrypted and
+    encrypted PCAP files are merged at the same time.
+    returns the paths of the encrypted and decrypted tshark JSON files
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        json_files = list(executor.map(
+            lambda encdec: merge_cap.merge_in_dir(encdec, apk_dir_path, projected=True,
+                                                  display_filter=merge_cap.OUTGOING_TRAFFIC_FILTER),
+            ["-enc", "-dec"]))
+    if None in json_files:
+        raise RuntimeError("Could not merge the PCAP files in " + apk_dir_path)
+    return json_files
+
+
+def write_intermediates_of_app(apk_dir_path: str, apk_dir: str, tshark_file_enc: str, tshark_file_dec: str,
+                               matchers: List) -> List[List]:
+    """
+    Steps 3-5 of the pipeline for one app, writing the NoMoAds JSON files (for debugging) along the way.
+    returns the CSV rows of the app
+    """
+    # 3) Produce a unified JSON file in NoMoAds-style.
+    nomoads_file = os.path.join(apk_dir_path, apk_dir + compare_results.FILE_SUFFIX)
+    data = extract_from_tshark.extract_data(tshark_file_enc, tshark_file_dec, include_http_body=True,
+                                            aggregate_flows=flow_aggregation)
+    source_hash = None
+    if data is None:
+        data = {}
+    else:
+        extract_from_tshark.write_data(data, nomoads_file, "w")
+        source_hash = block_decision_store.get_file_hash(nomoads_file)
 
-        # The pipeline
-        # 1) Merge PCAP files for each app into one PCAP file for encrypted traffic and
-        #    one PCAP file for decrypted traffic.
-        # 2) Produce tshark JSON files, each for encrypted and decrypted traffic PCAP files.
-        gui_globals.redirect_print_func(f"[+] {app_store_name}: Merging decrypted PCAP files and creating a JSON file using tshark...")
-        ret = subprocess.check_call(["python3", "merge_cap.py", "-dec", apk_dir_path])
-        gui_globals.redirect_print_func(f"[+] {app_store_name}: Merging encrypted PCAP files and creating a JSON file using tshark...")
-        ret = subprocess.check_call(["python3", "merge_cap.py", "-enc", apk_dir_path])
+    # 4) Run the unified JSON file through the filter-list matching script.
+    data = filter_list_checker_mult_dirs.annotate_with_all_filter_lists(matchers, data, decision_cache=decision_cache)
+    fl_result_dir = os.path.join(apk_dir_path, FL_RESULT_DIR)
+    os.makedirs(fl_result_dir, exist_ok=True)
+    annotated_file = os.path.join(fl_result_dir, os.path.basename(nomoads_file))
+    filter_list_checker_mult_dirs.write_annotated_nomoads_json(data, annotated_file)
+    block_decision_store.write_block_decisions(block_decision_store.get_decisions_file(annotated_file), source_hash,
+                                               block_decision_store.get_block_decisions(matchers, data),
+                                               annotated_hash=block_decision_store.get_file_hash(annotated_file))
+
+    # 5) Produce the CSV rows
+    fl_names = [fl_name for fl_name, _ in matchers]
+    app_id = compare_results.get_app_id(nomoads_file)
+    return list(compare_results.get_block_decision_rows(app_id, fl_names, data, include_http_body=True,
+                                                        include_flow_fields=flow_aggregation))
+
+
+def stream_app(apk_dir: str, tshark_file_enc: str, tshark_file_dec: str, matchers: List, log=print) -> List[List]:
+    """
+    Steps 3-5 of the pipeline for one app, fused: each packet extracted from the tshark JSON files is labeled with
+    PII, annotated with block decisions, and turned into a CSV row before the next one is extracted.
+    log: function that reports the progress of the app
+    returns the CSV rows of the app
+    """
+    packets = []
+    if extract_from_tshark.tshark_files_exist(tshark_file_enc, tshark_file_dec):
+        # 3) Produce packets in NoMoAds-style.
+        packets = extract_from_tshark.iter_packets(tshark_file_enc, tshark_file_dec, include_http_body=True,
+                                                   aggregate_flows=flow_aggregation)
+    else:
+        log("ERROR: invalid argument")
 
-        # 3) Produce a unified JSON file in NoMoAds-style.
-        gui_globals.redirect_print_func(f"[+] {app_store_name}: Creating a unified JSON file...\n")
-        ret = subprocess.check_call(["python3", "extract_from_tshark.py",
-            "--enc_file",
-            os.path.join(apk_dir_path, apk_dir + "-ENC-out.json"),
-            "--dec_file",
-            os.path.join(apk_dir_path, apk_dir + "-DEC-out.json"),
-            "--out_file",
-            os.path.join(apk_dir_path, apk_dir + "-out-nomoads.json"),
-            "--include_http_body"
-            ])
+    # 4) Run the packets through the filter-list matching.
+    packets = filter_list_checker_mult_dirs.annotate_packets(matchers, packets, decision_cache=decision_cache)
+
+    # 5) Produce the CSV rows
+    fl_names = [fl_name for fl_name, _ in matchers]
+    app_id = compare_results.get_app_id(apk_dir + compare_results.FILE_SUFFIX)
+    return list(compare_results.get_block_decision_rows(app_id, fl_names, packets, include_http_body=True,
+                                                        include_flow_fields=flow_aggregation))
 
-        apk_dir_path_tuple.append((apk_dir_path, apk_dir))
-    
-    apk_dir_paths_only = [x for x, _ in apk_dir_path_tuple]
 
+def process_app(apk_dir_path: str, apk_dir: str) -> Tuple[List[List], List[str]]:
+    """
+    Steps 1-5 of the pipeline for one app. Packets flow from one stage to the next without intermediate files, unless
+    write_intermediate_files is set. The CSV file of the app is written to the app subdirectory. If incremental_runs
+    is set and the manifest of the app shows that nothing changed since the last run, the rows of the last run are
+    returned instead. The progress messages are returned rather than logged, since this runs in a worker process when
+    apps are processed concurrently, and only the parent process may call the log function (e.g., of the GUI).
+    returns the CSV rows of the app (see compare_results.get_csv_header for the columns), and its progress messages
+    """
+    messages = []
+    log = messages.append
+    matchers = init_fl_matchers()
+    fl_result_dir = os.path.join(apk_dir_path, FL_RESULT_DIR)
+    os.makedirs(fl_result_dir, exist_ok=True)
+    csv_file = os.path.join(fl_result_dir, apk_dir + ".csv")
+    manifest_file = app_manifest.get_manifest_file(fl_result_dir, apk_dir)
+    rows_file = app_manifest.get_rows_file(fl_result_dir, apk_dir)
+    previous_manifest = app_manifest.read_manifest(manifest_file)
+    device = get_device_profile(apk_dir_path)
+    manifest = app_manifest.get_manifest(apk_dir_path, matchers, get_app_options(device), previous_manifest)
+    if incremental_runs and not write_intermediate_files and os.path.isfile(csv_file) and \
+            app_manifest.is_unchanged(manifest, previous_manifest):
+        rows = app_manifest.read_rows(rows_file)
+        if rows is not None:
+            log(f"[=] {apk_dir}: unchanged since the last run, reusing its rows")
+            return rows, messages
+    # the manifest is written again once the new rows are
+    if previous_manifest is not None:
+        os.remove(manifest_file)
+
+    # 1) Merge PCAP files for each app into one PCAP file for encrypted traffic and
+    #    one PCAP file for decrypted traffic.
+    # 2) Produce tshark JSON files, each for encrypted and decrypted traffic PCAP files.
+    tshark_file_enc, tshark_file_dec = merge_app_pcaps(apk_dir_path)
+
+    log(f"[+] {apk_dir}: scanning for the PII of device profile {device}")
+    extract_from_tshark.use_device_profile(device)
+
+    # 3) Produce a unified JSON file in NoMoAds-style.
     # 4) Run the unified JSON file through the filter-list matching script.
-    gui_globals.redirect_print_func(f"[+] {app_store_name}: Running the unified JSON file and matching the entries against filter lists...")
-    ret = subprocess.check_call(["python3", "filter_list_checker_mult_dirs.py", DIR_DELIMITER.join(apk_dir_paths_only), "filter_lists", FL_RESULT_DIR])
-    gui_globals.redirect_print_func("\n")
-    gui_globals.redirect_print_func(f"[+] {app_store_name}: Filter lists matching results are saved in " + DIR_DELIMITER.join(apk_dir_paths_only) + "...\n")
+    if write_intermediate_files:
+        rows = write_intermediates_of_app(apk_dir_path, apk_dir, tshark_file_enc, tshark_file_dec, matchers)
+    else:
+        rows = stream_app(apk_dir, tshark_file_enc, tshark_file_dec, matchers, log=log)
+    if decision_cache is not None:
+        decision_cache.flush()
+        log(f"[+] {apk_dir}: {decision_cache.get_stats(reset=True)}")
+    log(f"[+] {apk_dir}: {extract_from_tshark.pii_helper.get_body_scan_stats(reset=True)}")
+
+    # 5) Finally, produce a CSV file that contains the flow of traffic for further processing
+    #    (e.g., ATS analyses, policy analyses, etc.)
+    fl_names = [fl_name for fl_name, _ in matchers]
+    compare_results.write_csv(csv_file, get_csv_header(fl_names), rows)
+    app_manifest.write_rows(rows_file, rows)
+    app_manifest.write_manifest(manifest_file, manifest)
+    return rows, messages
+
+
+def rows_to_data_frame(header_row: List[str], rows: List[List]) -> pd.DataFrame:
+    """
+    returns a DataFrame of the CSV rows with the same values as if the rows were written to a CSV file and read back
+    with pd.read_csv
+    """
+    df = pd.DataFrame(rows, columns=header_row)
+    # The CSV writer stores the lists of PII types and URLs with str(), and pd.read_csv reads empty fields as missing
+    # values
+    df[compare_results.json_key_pii_found] = df[compare_results.json_key_pii_found].map(str)
+    if compare_results.json_key_urls in df.columns:
+        df[compare_results.json_key_urls] = df[compare_results.json_key_urls].map(str)
+    return df.replace("", np.nan)
+
+
+def save_table(df: pd.DataFrame, output_tmp_dir: str, table_name: str, table_format: str) -> str:
+    """
+    Saves a table of the pipeline to the temporary output directory.
+    table_format: traffic_store.PARQUET to write it to the traffic store, or traffic_store.CSV to write a CSV file
+    returns the path of the table
+    """
+    if table_format == traffic_store.PARQUET:
+        return traffic_store.write_table(os.path.join(output_tmp_dir, TRAFFIC_STORE_NAME), table_name, df)
+    csv_file = os.path.join(output_tmp_dir, table_name + ".csv")
+    df.to_csv(csv_file, index=False)
+    return csv_file
+
+
+def process_store(app_store_name: str, app_store_dir: str, apk_dir_path_tuple: List[Tuple[str, str]],
+                  output_tmp_dir: str, jobs: int = 1, log=print,
+                  decision_cache_file: str = BLOCK_DECISION_CACHE_FILE,
+                  write_intermediates: bool = False, table_format: str = traffic_store.get_default_format(),
+                  incremental: bool = True, aggregate_flows: bool = False, device: str = None,
+                  max_body_scan_bytes: int = None, skip_binary_bodies: bool = False) -> pd.DataFrame:
+    """
+    Runs the pipeline for the apps of one app store.
+    app_store_dir: directory where the CSV files of the apps are collected
+    decision_cache_file: SQLite file that keeps the block decisions across runs, or None
+    write_intermediates: whether to write the NoMoAds JSON files of each app, for debugging
+    table_format: format of the merged table of the app store, traffic_store.PARQUET or traffic_store.CSV
+    incremental: whether apps that did not change since the last run reuse their rows instead of being processed again
+    aggregate_flows: whether the packets of each TCP connection are aggregated into one flow record (one row)
+    device: device profile whose PII the traffic of all apps is scanned for, or None to detect it from the directory of
+    each app (see json_keys.get_device_profile)
+    max_body_scan_bytes: number of bytes of each HTTP, websocket, or irc body that are kept and scanned for PII, or
+    None to scan whole bodies
+    skip_binary_bodies: whether the binary parts of bodies are redacted instead of being scanned for PII
+    returns the merged traffic of the apps, with an app_store column
+    """
+    global write_intermediate_files, incremental_runs, flow_aggregation, device_profile
+    write_intermediate_files = write_intermediates
+    incremental_runs = incremental
+    flow_aggregation = aggregate_flows
+    device_profile = device
+    extract_from_tshark.use_body_scan_mode(max_body_scan_bytes, skip_binary_bodies)
+    for _, apk_dir in apk_dir_path_tuple:
+        log(f"[.] {app_store_name}: Begin the pipeline for app " + apk_dir + "...\n")
+    log(f"[+] {app_store_name}: Merging PCAP files, creating JSON files using tshark, creating unified JSON files, "
+        f"and matching the entries against filter lists with {jobs} job(s)...")
+    init_fl_matchers()
+    init_decision_cache(decision_cache_file)
+    app_rows = []
+    for rows, messages in map_apps(process_app, apk_dir_path_tuple, jobs):
+        for message in messages:
+            log(message)
+        app_rows.append(rows)
 
     # Make CSV directory to hold output
     csv_app_store_dir = app_store_dir + os.sep + "csv"
     if not os.path.isdir(csv_app_store_dir):
         os.makedirs(csv_app_store_dir, exist_ok=True)
 
-    # 5) Finally, produce a CSV file that contains the flow of traffic for further processing
-    #    (e.g., ATS analyses, policy analyses, etc.)
-    for apk_dir_path_tmp, apk_dir_tmp in apk_dir_path_tuple:
-        fl_result_dir = os.path.join(apk_dir_path_tmp, FL_RESULT_DIR)
-        gui_globals.redirect_print_func(f"[+] {app_store_name}: Generating the final CSV file in " + fl_result_dir + "...\n")
-        csv_file_path = os.path.join(fl_result_dir, apk_dir_tmp + ".csv")
-        ret = subprocess.check_call([
-            "python3",
-            "compare_results.py", fl_result_dir,
-            "filter_lists", csv_file_path,
-            "--include_http_body"
-            ])
-        gui_globals.redirect_print_func(f"[+] {app_store_name}: Copying the final CSV file into " + csv_app_store_dir + "...\n\n")
+    all_rows = []
+    for (apk_dir_path, apk_dir), rows in zip(apk_dir_path_tuple, app_rows):
+        csv_file_path = os.path.join(apk_dir_path, FL_RESULT_DIR, apk_dir + ".csv")
+        log(f"[+] {app_store_name}: Copying the final CSV file {csv_file_path} into " + csv_app_store_dir + "...\n\n")
         shutil.copy(csv_file_path, csv_app_store_dir)
+        all_rows.extend(rows)
 
-    # merge csv into one per store
-    merged_file_one_store = os.path.join(output_tmp_dir, f"{app_store_name}-merged.csv")
-
-    cmd = f"awk '(NR == 1) || (FNR > 1)' *.csv > {merged_file_one_store}"
-    subprocess.check_output(cmd, shell=True, cwd=csv_app_store_dir)
-    gui_globals.redirect_print_func(f"[+] {app_store_name}: Created merged csv {merged_file_one_store}")
+    # merge rows into one table per store, in the (sorted) order of the apps
+    fl_names = [fl_name for fl_name, _ in init_fl_matchers()]
+    df = rows_to_data_frame(get_csv_header(fl_names), all_rows)
+    merged_file_one_store = save_table(df, output_tmp_dir, f"{app_store_name}-merged", table_format)
+    log(f"[+] {app_store_name}: Created merged table {merged_file_one_store}")
 
     # add the app_store column with the name
-    df = pd.read_csv(merged_file_one_store)
     df["app_store"] = app_store_name
-    data_frames.append(df)
+    return df
+
+
+def left_join(left_df: pd.DataFrame, right_df: pd.DataFrame, left_on: str, right_on: str,
+              right_columns: Dict[str, str]) -> pd.DataFrame:
+    """
+    SQL left join of two tables on a key column: each row of left_df is kept, and repeated for each row of right_df
+    with the same key. Rows with a missing key never match, like NULL in SQL.
+    right_columns: columns of right_df to add to the rows of left_df, and their names in the result
+    returns the joined table, with a new index
+    """
+    join_key = "__join_key"
+    right_df = right_df.loc[right_df[right_on].notna(), list(right_columns)].rename(columns=right_columns) \
+        .assign(**{join_key: right_df[right_on]})
+    joined = left_df.merge(right_df, how="left", left_on=left_on, right_on=join_key, sort=False)
+    return joined.drop(columns=join_key)
+
+
+def enrich_and_label(data_frames: List[pd.DataFrame], app_store_csvs_abs_dir: str, output_tmp_dir: str,
+                     table_format: str = traffic_store.get_default_format(),
+                     esld_cache_file: str = ESLD_CACHE_FILE, log=print) -> str:
+    """
+    Merges the traffic of all app stores, and adds the eSLD, app store information, and party labels.
+    table_format: format of the intermediate and final tables, traffic_store.PARQUET or traffic_store.CSV. The final
+    table is exported to a CSV file in both cases.
+    esld_cache_file: JSON file that keeps the resolved eSLDs across runs, or None
+    log: function that reports the progress (e.g., to the GUI)
+    returns the path of the final CSV file
+    """
+    resolver = esld_resolver.init_resolver(esld_cache_file)
 
     # merge everything together
-    all_merged = pd.concat(data_frames)
-    all_merged_file = output_tmp_dir + os.sep + "all-merged.csv"
-    all_merged.to_csv(all_merged_file, index=False)
+    all_merged = pd.concat(data_frames, ignore_index=True)
+    save_table(all_merged, output_tmp_dir, "all-merged", table_format)
 
     # add esld
-    all_merged_with_esld_file = output_tmp_dir + os.sep + "all-merged-with-esld.csv"
-    ret = subprocess.check_call(["python3", "append_sld_to_csv.py", all_merged_file, all_merged_with_esld_file])
+    all_merged_with_esld_df = append_sld_to_csv.add_second_level_domains(all_merged)
+    if table_format == traffic_store.PARQUET:
+        # the eSLD is added to the stored table as a new column, without rewriting its rows
+        traffic_store.append_columns(os.path.join(output_tmp_dir, TRAFFIC_STORE_NAME), "all-merged",
+                                     all_merged_with_esld_df[[append_sld_to_csv.csv_key_sld_label]])
+    else:
+        save_table(all_merged_with_esld_df, output_tmp_dir, "all-merged-with-esld", table_format)
 
     # read in other CSVs
-    all_merged_with_esld_df = pd.read_csv(all_merged_with_esld_file)
     all_150_top_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + "all_150_top_apps.csv")
     oculus_store_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + "oculus_store_apps.csv")
     sidequest_store_apps_df = pd.read_csv(app_store_csvs_abs_dir + os.sep + "sidequest_store_apps.csv")
 
-    sql_env = {
-        "all_merged_with_esld_df": all_merged_with_esld_df,
-        "all_150_top_apps_df": all_150_top_apps_df,
-        "oculus_store_apps_df": oculus_store_apps_df,
-        "sidequest_store_apps_df": sidequest_store_apps_df
-    }
-
     # add in app title,game engine, and developer privacy policy
-    all_merged_with_esld_engine_privacy_df = sqldf("select merged.*, App_Title, Game_Engine, Actual_Developer_Privacy_Policy, Final_Status  from all_merged_with_esld_df  as merged left join all_150_top_apps_df as topapps on merged.app_id == topapps.package_name;", env=sql_env)
+    all_merged_with_esld_engine_privacy_df = left_join(
+        all_merged_with_esld_df, all_150_top_apps_df, "app_id", "package_name",
+        {"App_Title": "App_Title", "Game_Engine": "Game_Engine",
+         "Actual_Developer_Privacy_Policy": "Actual_Developer_Privacy_Policy", "Final_Status": "Final_Status"})
 
     all_merged_with_esld_engine_privacy_df = all_merged_with_esld_engine_privacy_df[all_merged_with_esld_engine_privacy_df["Final_Status"] == "Working"]
 
     # add in developer name
-    sql_query = \
-        """
-        select ocmerged.*, oc.Developer as "oculus_creator", s.Creator as "sidequest_creator" from all_merged_with_esld_engine_privacy_df as ocmerged
-        left join oculus_store_apps_df as oc on ocmerged.App_Title == oc.App_Title
-        left join sidequest_store_apps_df as s on ocmerged.App_Title == s.App_Title;
-        """
-    sql_env["all_merged_with_esld_engine_privacy_df"] = all_merged_with_esld_engine_privacy_df
-    all_merged_with_esld_engine_privacy_developer_df = sqldf(sql_query, sql_env)
-    all_merged_with_esld_engine_privacy_developer_file = output_tmp_dir + os.sep + "all-merged-with-esld-engine-privacy-developer.csv"
-    all_merged_with_esld_engine_privacy_developer_df.to_csv(all_merged_with_esld_engine_privacy_developer_file,
-                                                            index=False)
+    all_merged_with_esld_engine_privacy_developer_df = left_join(
+        all_merged_with_esld_engine_privacy_df, oculus_store_apps_df, "App_Title", "App_Title",
+        {"Developer": "oculus_creator"})
+    all_merged_with_esld_engine_privacy_developer_df = left_join(
+        all_merged_with_esld_engine_privacy_developer_df, sidequest_store_apps_df, "App_Title", "App_Title",
+        {"Creator": "sidequest_creator"})
+    save_table(all_merged_with_esld_engine_privacy_developer_df, output_tmp_dir,
+               "all-merged-with-esld-engine-privacy-developer", table_format)
     # add party label
-    all_merged_with_esld_engine_privacy_developer_party_file = output_tmp_dir + os.sep + "all-merged-with-esld-engine-privacy-developer-party.csv"
-    ret = subprocess.check_call(
-        ["python3", "oculus_hostname_fp_tp_csv_generator.py", all_merged_with_esld_engine_privacy_developer_file, all_merged_with_esld_engine_privacy_developer_party_file])
+    all_merged_with_esld_engine_privacy_developer_party_df = oculus_hostname_fp_tp_csv_generator.add_party_labels(
+        all_merged_with_esld_engine_privacy_developer_df)
+    resolver.save()
+    log(resolver.get_stats())
+    all_merged_with_esld_engine_privacy_developer_party_name = "all-merged-with-esld-engine-privacy-developer-party"
+    if table_format == traffic_store.PARQUET:
+        save_table(all_merged_with_esld_engine_privacy_developer_party_df, output_tmp_dir,
+                   all_merged_with_esld_engine_privacy_developer_party_name, table_format)
+    # the final table is always exported to CSV
+    return save_table(all_merged_with_esld_engine_privacy_developer_party_df, output_tmp_dir,
+                      all_merged_with_esld_engine_privacy_developer_party_name, traffic_store.CSV)
+
+
+def run(dataset_root_dir: str, app_store_csvs_dir: str, jobs: int = 1,
+        decision_cache_file: str = BLOCK_DECISION_CACHE_FILE, write_intermediates: bool = False,
+        table_format: str = traffic_store.get_default_format(), incremental: bool = True,
+        aggregate_flows: bool = False, device: str = None, max_body_scan_bytes: int = None,
+        skip_binary_bodies: bool = False):
+    """
+    dataset_root_dir: root directory of dataset
+    app_store_csvs_dir: directory of csvs about app stores
+    jobs: number of apps processed concurrently
+    decision_cache_file: SQLite file that keeps the block decisions across runs, or None
+    write_intermediates: whether to write the NoMoAds JSON files of each app, for debugging
+    table_format: format of the merged tables, traffic_store.PARQUET or traffic_store.CSV (the final table is also
+    exported to CSV)
+    incremental: whether apps that did not change since the last run reuse their rows instead of being processed again
+    aggregate_flows: whether the packets of each TCP connection are aggregated into one flow record (one row)
+    device: device profile whose PII the traffic of all apps is scanned for, or None to detect it from the directory of
+    each app
+    max_body_scan_bytes: number of bytes of each HTTP, websocket, or irc body that are kept and scanned for PII, or
+    None to scan whole bodies
+    skip_binary_bodies: whether the binary parts of bodies are redacted instead of being scanned for PII
+    """
+
+    dataset_root_abs_dir = os.path.abspath(dataset_root_dir)
+    app_store_csvs_abs_dir = os.path.abspath(app_store_csvs_dir)
+
+    output_tmp_dir = dataset_root_abs_dir + os.sep + TEMP_OUTPUT_NAME
+    if os.path.isdir(output_tmp_dir):
+        shutil.rmtree(output_tmp_dir)
+    os.makedirs(output_tmp_dir)
+
+    # For each app store:
+    #   Iterate over APK subdirectories that contain the PCAP files and run the pipeline on them
+    app_store_name = "ALL"
+    app_store_dir = os.path.join(dataset_root_abs_dir, app_store_name)
+
+    apk_dir_path_tuple = list_apk_dirs(dataset_root_abs_dir, [TEMP_OUTPUT_NAME, CSV_TMP_NAME])
+    gui_globals.redirect_print_func(f"Processing data from App apk: {app_store_name}")
+    df = process_store(app_store_name, app_store_dir, apk_dir_path_tuple, output_tmp_dir, jobs=jobs,
+                       log=gui_globals.redirect_print_func, decision_cache_file=decision_cache_file,
+                       write_intermediates=write_intermediates, table_format=table_format,
+                       incremental=incremental, aggregate_flows=aggregate_flows, device=device,
+                       max_body_scan_bytes=max_body_scan_bytes, skip_binary_bodies=skip_binary_bodies)
+
+    final_csv_file = enrich_and_label([df], app_store_csvs_abs_dir, output_tmp_dir, table_format=table_format,
+                                      log=gui_globals.redirect_print_func)
 
     # copy final CSV to the root dir
-    shutil.copy(all_merged_with_esld_engine_privacy_developer_party_file, dataset_root_abs_dir)
-    gui_globals.redirect_print_func(f"Final CSV is in {dataset_root_abs_dir + os.sep + os.path.basename(all_merged_with_esld_engine_privacy_developer_party_file)}")
\ No newline at end of file
+    shutil.copy(final_csv_file, dataset_root_abs_dir)
+    gui_globals.redirect_print_func(f"Final CSV is in {dataset_root_abs_dir + os.sep + os.path.basename(final_csv_file)}")
@@ -0,0 +1,178 @@
+"""
+Parquet-backed store for the traffic tables of the pipeline (requires pyarrow; CSV files are used without it).
+Each table is a directory in the store directory:
+- The rows, in Parquet files partitioned by app (one subdirectory per app id), with typed columns. Hostnames, app ids,
+  and the other repetitive string columns are dictionary-encoded.
+- "_columns": one Parquet file per column appended after the table was written, so that adding a column does not
+  rewrite the rows.
+- "_table.json": the order of the columns and of the partition columns.
+A "_row_id" column keeps the order of the rows, which the partitioning does not.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+PARQUET = "parquet"
+CSV = "csv"
+TABLE_FORMATS = [PARQUET, CSV]
+
+APP_ID = "app_id"
+# String columns with few distinct values, dictionary-encoded in the Parquet files
+DICTIONARY_COLUMNS = [APP_ID, "protocol", "src_ip", "dst_ip", "hostname", "package_name", "esld", "app_store",
+                      "App_Title", "Game_Engine", "oculus_creator", "sidequest_creator"]
+
+ROW_ID = "_row_id"
+APPENDED_COLUMNS_DIR = "_columns"
+TABLE_METADATA_FILE = "_table.json"
+
+
+def is_available():
+    """
+    :return: True if pyarrow is installed, so that tables can be stored in Parquet format.
+    """
+    return pa is not None
+
+
+def get_default_format():
+    """
+    :return: The format of the tables of the pipeline: Parquet if pyarrow is installed, CSV otherwise.
+    """
+    return PARQUET if is_available() else CSV
+
+
+def _require_pyarrow():
+    if not is_available():
+        raise RuntimeError("pyarrow is required for the Parquet traffic store (pip3 install pyarrow)")
+
+
+def _get_table_dir(store_dir, table_name):
+    return os.path.join(store_dir, table_name)
+
+
+def _read_metadata(table_dir):
+    with open(os.path.join(table_dir, TABLE_METADATA_FILE), "r") as f:
+        return json.load(f)
+
+
+def _write_metadata(table_dir, metadata):
+    with open(os.path.join(table_dir, TABLE_METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=4)
+
+
+def _to_str(value):
+    return value if pd.isna(value) else str(value)
+
+
+def _to_arrow(df):
+    """
+    :return: The Arrow table of the DataFrame. Object columns are stored as strings (missing values stay null), since
+             a column read from a CSV file may mix strings with other values.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(_to_str)
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _get_dictionary_columns(columns):
+    return [column for column in columns if column in DICTIONARY_COLUMNS]
+
+
+def write_table(store_dir, table_name, df, partition_cols=(APP_ID,)):
+    """
+    Writes a table to the store, replacing the table with the same name.
+    :param store_dir: The directory of the store.
+    :param table_name: The name of the table.
+    :param df: The rows of the table.
+    :param partition_cols: The columns the rows are partitioned by (if they are in the table).
+    :return: The directory of the table.
+    """
+    _require_pyarrow()
+    table_dir = _get_table_dir(store_dir, table_name)
+    if os.path.isdir(table_dir):
+        shutil.rmtree(table_dir)
+    os.makedirs(table_dir)
+
+    partition_cols = [column for column in partition_cols if column in df.columns]
+    rows = df.reset_index(drop=True)
+    rows[ROW_ID] = np.arange(len(rows), dtype=np.int64)
+    table = _to_arrow(rows)
+    pq.write_to_dataset(table, table_dir, partition_cols=partition_cols or None,
+                        use_dictionary=_get_dictionary_columns(table.column_names))
+
+    _write_metadata(table_dir, {"columns": list(df.columns), "partition_cols": partition_cols,
+                                "appended_columns": []})
+    return table_dir
+
+
+def append_columns(store_dir, table_name, columns_df):
+    """
+    Adds columns to a table of the store without rewriting its rows.
+    :param columns_df: The new columns, with one row for each row of the table, in the order of the table.
+    """
+    _require_pyarrow()
+    table_dir = _get_table_dir(store_dir, table_name)
+    metadata = _read_metadata(table_dir)
+    columns_dir = os.path.join(table_dir, APPENDED_COLUMNS_DIR)
+    os.makedirs(columns_dir, exist_ok=True)
+
+    for column in columns_df.columns:
+        if column in metadata["columns"]:
+            raise ValueError("Column %s is already in table %s" % (column, table_name))
+        column_df = pd.DataFrame({ROW_ID: np.arange(len(columns_df), dtype=np.int64),
+                                  column: columns_df[column].reset_index(drop=True)})
+        column_table = _to_arrow(column_df)
+        pq.write_table(column_table, os.path.join(columns_dir, "%d.parquet" % len(metadata["appended_columns"])),
+                       use_dictionary=_get_dictionary_columns(column_table.column_names))
+        metadata["columns"].append(column)
+        metadata["appended_columns"].append(column)
+    _write_metadata(table_dir, metadata)
+
+
+def read_table(store_dir, table_name, columns=None):
+    """
+    Reads a table of the store.
+    :param columns: The columns to read, or None to read all of them.
+    :return: The rows of the table, in the order they were written.
+    """
+    _require_pyarrow()
+    table_dir = _get_table_dir(store_dir, table_name)
+    metadata = _read_metadata(table_dir)
+    if columns is None:
+        columns = metadata["columns"]
+
+    appended_columns = metadata["appended_columns"]
+    base_columns = [column for column in columns if column not in appended_columns]
+    partitioning = ds.partitioning(pa.schema([(column, pa.string()) for column in metadata["partition_cols"]]),
+                                   flavor="hive") if metadata["partition_cols"] else None
+    # Files and directories starting with "_" (the appended columns and the metadata) are not part of the dataset
+    dataset = ds.dataset(table_dir, format="parquet", partitioning=partitioning)
+    df = dataset.to_table(columns=base_columns + [ROW_ID]).to_pandas()
+    df = df.sort_values(ROW_ID, kind="stable").set_index(ROW_ID)
+
+    for i, column in enumerate(appended_columns):
+        if column not in columns:
+            continue
+        column_df = pq.read_table(os.path.join(table_dir, APPENDED_COLUMNS_DIR, "%d.parquet" % i)).to_pandas()
+        df[column] = column_df.set_index(ROW_ID)[column]
+
+    return df[columns].reset_index(drop=True)
+
+
+def export_csv(store_dir, table_name, csv_file):
+    """
+    Writes a table of the store to a CSV file.
+    """
+    read_table(store_dir, table_name).to_csv(csv_file, index=False)
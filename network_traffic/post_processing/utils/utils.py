@@ -69,3 +69,30 @@ def readable_dirs(prospective_dirs):
         raise Exception("No valid directories found in %s", prospective_dirs)
 
     return existing_dirs
+
+
+def list_filter_lists(filter_list_dir):
+    """
+    Lists the filter list files in a directory. The name of a filter list is its filename minus the file extension,
+    which is also the JSON key of its block decision in annotated NoMoAds JSON.
+    :param filter_list_dir: Path to a directory containing filter lists in EasyList (ABP) format.
+    :return: a list of tuples (filter list name, filter list path), sorted by name
+    """
+    filter_lists = []
+    for fl_file in sorted(os.listdir(filter_list_dir)):
+        if "DS_Store" in fl_file:
+            continue
+        ext_start = fl_file.rfind(".")
+        if ext_start < 0:
+            print("WARNING: skipping filter list file '" + fl_file +
+                  "' as the filename does not contain a file extension.")
+            continue
+        # Name of filter list becomes filename minus file extension
+        fl_name = fl_file[0:ext_start]
+        if len(fl_name) == 0:
+            print("WARNING: skipping filter list file '" + fl_file +
+                  "' as the filename is empty before the file extension")
+            continue
+        filter_lists.append((fl_name, os.path.join(filter_list_dir, fl_file)))
+
+    return filter_lists
@@ -15,8 +15,14 @@ import lib.ConsistencyDatabase as conDB
 from lib.TermPreprocessor2 import TermPreprocessor
 spacy.prefer_gpu()
 
+# the domains of the flows are resolved with the eSLD resolver (and cache) of the network traffic post-processing
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, '..', '..'))
+from network_traffic.post_processing import esld_resolver
+
 DATA_ROOT = Path(sys.argv[1])
-TermPreprocessor.initialize(DATA_ROOT / 'data')
+resolver = esld_resolver.init_resolver(esld_resolver.DEFAULT_CACHE_FILE)
+TermPreprocessor.initialize(DATA_ROOT / 'data', extract_domain=resolver.extract)
 
 
 def fixEntityLemma(txt, nlp):
@@ -328,6 +334,9 @@ def main():
 
         print('Ending', polPath)
 
+    resolver.save()
+    print(resolver.get_stats())
+
 
 if __name__ == '__main__':
     main()
@@ -14,6 +14,9 @@ import bs4
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(SCRIPT_DIR, '..', 'code'))
 from lib.TermPreprocessor2 import TermPreprocessor as tprep
+# the domains are resolved with the eSLD resolver (and cache) of the network traffic post-processing
+sys.path.append(os.path.join(SCRIPT_DIR, '..', '..'))
+from network_traffic.post_processing import esld_resolver
 
 
 DATA_ROOT = Path(sys.argv[1])
@@ -22,7 +25,8 @@ try:
 except IndexError:
     append_mode = False
 
-tprep.initialize(DATA_ROOT / 'data')
+resolver = esld_resolver.init_resolver(esld_resolver.DEFAULT_CACHE_FILE)
+tprep.initialize(DATA_ROOT / 'data', extract_domain=resolver.extract)
 URL_MAPPING = {
     # the first one of each entity is actually used
     '//unity3d.com/legal/privacy-policy': 'unity',
@@ -99,6 +103,7 @@ for filepath in (DATA_ROOT / 'html_policies').iterdir():
                                               policy_urls.get(package_name, ''), '')
                 if entity != 'we':
                     print(package_name, url, entity)
+resolver.save()
 
 with open(DATA_ROOT / 'data' / 'policheck_flows_new.csv', 'w', newline='') as fout:
     writer = csv.DictWriter(fout, csv_fields)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import functools
 import os
 import re
 
@@ -8,6 +9,11 @@ from lxml import etree
 import tldextract
 import yaml
 
+# Fallback that parses domains offline with the public suffix list bundled with tldextract, memoized. The PoliCheck
+# scripts give TermPreprocessor.initialize the eSLD resolver of the network traffic post-processing instead.
+default_extract_domain = functools.lru_cache(maxsize=100000)(tldextract.TLDExtract(cache_dir=None,
+                                                                                   suffix_list_urls=()))
+
 
 def loadAnnotations(filename='synonyms.xml'):
     def getTerm(node):
@@ -44,10 +50,16 @@ class TermPreprocessor:
     entity_map = None
     data_map = None
     domain_map = None
+    extract_domain = staticmethod(default_extract_domain)
     initialized = False
 
     @classmethod
-    def initialize(cls, ont_root):
+    def initialize(cls, ont_root, extract_domain=None):
+        """
+        :param extract_domain: function that parses a domain or URL like tldextract.extract, e.g., the extract method
+            of the esld_resolver.ESLDResolver of the network traffic post-processing, so that both use the same
+            resolver. Domains are parsed with default_extract_domain by default.
+        """
         def rmap(d):
             ret = dict()
             for name, li in d.items():
@@ -71,6 +83,8 @@ class TermPreprocessor:
             rd = loadAnnotations(os.path.join(ont_root, "synonyms.xml"))
             cls.entity_map = cls.data_map = cls.domain_map = rd
 
+        if extract_domain is not None:
+            cls.extract_domain = staticmethod(extract_domain)
         cls.initialized = True
 
     @classmethod
@@ -103,7 +117,7 @@ class TermPreprocessor:
         cls.__verify_initialization()
         domain = domain.lower()
 
-        if isFirstParty(packageName, domain, policyUrl, developerName):
+        if isFirstParty(packageName, domain, policyUrl, developerName, extract_domain=cls.extract_domain):
             return 'we'
 
         while '.' in domain:
@@ -204,12 +218,12 @@ IGNORE_PACKAGE_TOKENS = ["com", "android", "free", "paid", "co"]
 CLOUD_PROVIDER_DOMAINS = ["amazonaws.com", "digitaloceanspaces.com"]
 DEVELOPER_FIRST_PARTY_TOKENS = ["oculus", "facebook", "unity"]
 
-def isFirstParty(package_name, dest_domain, privacy_policy, developer_name):
+def isFirstParty(package_name, dest_domain, privacy_policy, developer_name, extract_domain=default_extract_domain):
     # tokenize package_name
     package_name_tokens = package_name.split(".")
     package_name_tokens = [x.lower() for x in package_name_tokens if x.lower() not in IGNORE_PACKAGE_TOKENS and len(x.strip()) > 2]
 
-    dest_domain_parsed = tldextract.extract(dest_domain)
+    dest_domain_parsed = extract_domain(dest_domain)
 
     # extract the eSLD for comparison
     # if it's hosted on a cloud service, take the subdomain instead
@@ -220,7 +234,7 @@ def isFirstParty(package_name, dest_domain, privacy_policy, developer_name):
 
     # check privacy policy url first
     if privacy_policy and privacy_policy != "N/A":
-        policy_domain_parsed = tldextract.extract(privacy_policy)
+        policy_domain_parsed = extract_domain(privacy_policy)
         if policy_domain_parsed.registered_domain == domain_cmp:
             return True
 
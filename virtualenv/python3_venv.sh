@@ -22,8 +22,8 @@ if [[ ! -d python3_venv ]]; then
 	pip3 install selenium==3.141.0
 	# Post-processing
 	pip3 install pandas==1.3.3
-	pip3 install pandasql==0.7.3
 	pip3 install adblockparser==0.7
+	pip3 install pyarrow==5.0.0
 	pip3 install urllib3==1.26.7
 	# Network-to-policy consistency and purpose extraction
 	pip3 install spacy==2.0.18